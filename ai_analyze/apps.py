@@ -1,6 +1,31 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def _serving():
+    """
+    Whether this process serves requests. Management commands other than
+    ``runserver`` (migrate, collectstatic, test...) do not, and neither does
+    the autoreloader parent of ``runserver``, which only restarts the child.
+    """
+    if os.path.basename(sys.argv[0]) not in ("manage.py", "django-admin"):
+        return True
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command != "runserver":
+        return False
+    return "--noreload" in sys.argv or os.environ.get("RUN_MAIN") == "true"
 
 
 class AiAnalyzeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ai_analyze'
+
+    def ready(self):
+        # With an inference server the web workers never run the model.
+        if getattr(settings, "AI_EAGER_WARMUP", False) and not settings.AI_INFERENCE_SOCKET and _serving():
+            from .fastvlm_service import start_warmup
+
+            start_warmup()
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+ANALYSIS_CACHE_SIZE = 2048
+ANALYSIS_CACHE_TTL_SEC = 6 * 3600
+# Bits out of 64 two difference hashes may differ by and still count as the
+# same photo, e.g. after a client re-encodes or slightly rescales it. Only
+# photos uploaded by the same owner are compared this way.
+ANALYSIS_CACHE_MAX_DISTANCE = 2
+
+
+def content_key(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def dhash(image: Image.Image) -> int:
+    """64-bit difference hash: is each pixel of a 9x8 grayscale thumbnail brighter than its right neighbour."""
+    pixels = image.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(0, 72, 9):
+        for column in range(row, row + 8):
+            value = (value << 1) | (pixels[column] > pixels[column + 1])
+    return value
+
+
+class AnalysisCache:
+    """
+    Thread-safe LRU of post-filtered detector items per uploaded image.
+    Entries are found by exact content hash first and otherwise by a
+    difference hash within ``max_distance`` bits of an entry with the same
+    ``owner``, so one user's photo never stands in for another's near
+    lookalike; they expire after ``ttl_sec``.
+    """
+
+    def __init__(self, max_entries=ANALYSIS_CACHE_SIZE, ttl_sec=ANALYSIS_CACHE_TTL_SEC, max_distance=ANALYSIS_CACHE_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return _copy(entry[3])
+
+    def get_similar(self, image_hash, owner):
+        if owner is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_distance = None, self.max_distance + 1
+            for key, (expires_at, entry_hash, entry_owner, _) in self._entries.items():
+                if expires_at <= now or entry_owner != owner:
+                    continue
+                distance = (entry_hash ^ image_hash).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+                    if not distance:
+                        break
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return _copy(self._entries[best_key][3])
+
+    def put(self, key, image_hash, items, owner=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_sec, image_hash, owner, _copy(items))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _copy(items):
+    return [dict(item) for item in items]
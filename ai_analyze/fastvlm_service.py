@@ -1,15 +1,26 @@
+import io
 import os
-import tempfile
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # import torch
-from PIL import Image
-from ultralytics import YOLO
+from PIL import Image, ImageOps
+
+from .cache import AnalysisCache, content_key, dhash
 
 YOLO_WEIGHTS = "yolov8n##.pt"
 
 YOLO_CONF = 0.25
 
+# Uploads are decoded, oriented and letterboxed to the model's square input.
+MODEL_INPUT_SIZE = 640
+LETTERBOX_FILL = (114, 114, 114)
+
+# Images per forward pass; larger requests run in several batches.
+YOLO_MAX_BATCH = int(os.getenv("YOLO_MAX_BATCH", "8"))
+IMAGE_DECODE_WORKERS = int(os.getenv("IMAGE_DECODE_WORKERS", "4"))
+
 ALLOWED_ITEMS = {
     "Sofa",
     "Bed",
@@ -105,6 +116,10 @@ POST_FILTER_MAP = {
 }
 
 
+class InvalidImageError(ValueError):
+    pass
+
+
 def _is_fragile(label: str) -> bool:
     return label in {"TV", "TV Stand", "Fragile Box", "Air Conditioner"}
 
@@ -163,63 +178,187 @@ def recommend_vehicle_type(total_volume_m3):
 
 class HybridMoveLineDetector:
     def __init__(self):
+        # ultralytics pulls in torch (seconds and hundreds of MB), so it is
+        # only imported by processes that actually run the detector.
+        from ultralytics import YOLO
+
         # self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.yolo = YOLO(YOLO_WEIGHTS)
 
-    # @torch.no_grad()
-    # def _detect_with_yolo(self, image_path: str):
-    #     results = self.yolo(image_path, conf=YOLO_CONF, verbose=False)
-    #     r = results[0]
-    #     names = r.names
-
-    #     labels = []
-    #     if r.boxes is not None and r.boxes.cls is not None:
-    #         for c in r.boxes.cls.tolist():
-    #             labels.append(names[int(c)])
-    #     return Counter(labels)
-
-    def predict(self, image_path: str):
-        yolo_counts = self._detect_with_yolo(image_path)
-        raw_items = []
-        for label, qty in yolo_counts.items():
-            raw_items.append(
-                {
-                    "label": label,
-                    "quantity": int(qty),
-                    "is_fragile": False,
-                }
-            )
-        return raw_items
+    def _detect_with_yolo(self, images):
+        # YOLO takes RGB PIL images and BGR numpy arrays as they are, so
+        # nothing is re-encoded or written to disk.
+        counts = []
+        for start in range(0, len(images), YOLO_MAX_BATCH):
+            results = self.yolo(images[start : start + YOLO_MAX_BATCH], conf=YOLO_CONF, verbose=False)
+            for r in results:
+                names = r.names
+                labels = []
+                if r.boxes is not None and r.boxes.cls is not None:
+                    for c in r.boxes.cls.tolist():
+                        labels.append(names[int(c)])
+                counts.append(Counter(labels))
+        return counts
+
+    def predict_batch(self, images):
+        """Raw items per image, running the images through YOLO in batches."""
+        batch_items = []
+        for yolo_counts in self._detect_with_yolo(list(images)):
+            raw_items = []
+            for label, qty in yolo_counts.items():
+                raw_items.append(
+                    {
+                        "label": label,
+                        "quantity": int(qty),
+                        "is_fragile": False,
+                    }
+                )
+            batch_items.append(raw_items)
+        return batch_items
+
+    def predict(self, image):
+        return self.predict_batch([image])[0]
 
 
 _detector = None
+_detector_lock = threading.Lock()
+# Threads start on first use, so idle processes pay nothing for the pool.
+_decode_pool = ThreadPoolExecutor(max_workers=IMAGE_DECODE_WORKERS, thread_name_prefix="image-decode")
+_warm = threading.Event()
+_warmup_error = None
+
+# Items per uploaded photo, so re-uploads skip the detector.
+analysis_cache = AnalysisCache()
 
 
 def _get_detector():
     global _detector
     if _detector is None:
-        _detector = HybridMoveLineDetector()
+        with _detector_lock:
+            if _detector is None:
+                _detector = HybridMoveLineDetector()
     return _detector
 
 
-def analyze_image(pil_image: Image.Image) -> dict:
-    detector = _get_detector()
-    tmp_path = None
+def warm_up():
+    """Load the model and run one dummy inference so the first request is fast."""
+    global _warmup_error
     try:
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-            tmp_path = tmp.name
-        pil_image.save(tmp_path, format="JPEG")
-        raw_items = detector.predict(tmp_path)
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except OSError:
-                pass
-    items = _post_filter_items(raw_items)
+        _get_detector().predict(Image.new("RGB", (640, 640)))
+    except Exception as exc:
+        _warmup_error = exc
+        raise
+    _warmup_error = None
+    _warm.set()
+
+
+def start_warmup():
+    threading.Thread(target=warm_up, name="ai-warmup", daemon=True).start()
+
+
+def readiness() -> dict:
+    return {
+        "ready": _warm.is_set(),
+        "error": str(_warmup_error) if _warmup_error is not None else None,
+    }
+
+
+def _fit(size, limit):
+    scale = limit / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def letterbox(image: Image.Image, size=MODEL_INPUT_SIZE) -> Image.Image:
+    """Scale ``image`` to fit a ``size`` square and pad it like YOLO does."""
+    fitted = _fit(image.size, size)
+    if fitted != image.size:
+        image = image.resize(fitted, Image.BILINEAR, reducing_gap=3.0)
+    if image.size == (size, size):
+        return image
+    canvas = Image.new("RGB", (size, size), LETTERBOX_FILL)
+    left, top = (size - image.width) // 2, (size - image.height) // 2
+    canvas.paste(image, (left, top))
+    canvas.info["letterbox"] = (left, top, left + image.width, top + image.height)
+    return canvas
+
+
+def _decode_image(file) -> Image.Image:
+    image = Image.open(file)
+    # JPEGs decode straight to 1/2, 1/4 or 1/8 scale, never below what the
+    # model needs, instead of the full 12+ MP; other formats ignore this.
+    image.draft("RGB", _fit(image.size, MODEL_INPUT_SIZE))
+    image = ImageOps.exif_transpose(image)
+    return letterbox(image.convert("RGB"))
+
+
+def decode_images(files) -> list:
+    """
+    Decode uploads to model-sized RGB PIL images on a shared thread pool;
+    Pillow releases the GIL while decoding. Raises the first decode error.
+    """
+    files = list(files)
+    if len(files) < 2:
+        return [_decode_image(file) for file in files]
+    return list(_decode_pool.map(_decode_image, files))
+
+
+def _summary(items) -> dict:
     total_volume = estimate_total_volume_m3(items)
     return {
         "items": items,
         "estimated_total_volume_m3": round(total_volume, 2),
         "recommended_vehicle_type": recommend_vehicle_type(total_volume),
     }
+
+
+def analyze_blobs(blobs, predict_batch=None, owner=None) -> list:
+    """
+    Post-filtered items per encoded image. Images already in
+    ``analysis_cache`` (same bytes, or a near-identical difference hash of a
+    photo from the same ``owner``) skip decoding or inference; the rest go
+    through ``predict_batch`` (the local detector by default) in one call.
+    Raises ``InvalidImageError`` for data that cannot be decoded.
+    """
+    keys = [content_key(blob) for blob in blobs]
+    results = [analysis_cache.get(key) for key in keys]
+    misses = [index for index, items in enumerate(results) if items is None]
+    if not misses:
+        return results
+
+    try:
+        images = decode_images(io.BytesIO(blobs[index]) for index in misses)
+    except Exception as exc:
+        raise InvalidImageError(str(exc)) from exc
+    pending = []
+    for index, image in zip(misses, images):
+        # Hash the photo only: letterbox padding would make different photos
+        # of the same shape look alike.
+        image_hash = dhash(image.crop(image.info["letterbox"]) if "letterbox" in image.info else image)
+        results[index] = analysis_cache.get_similar(image_hash, owner)
+        if results[index] is None:
+            pending.append((index, image, image_hash))
+
+    if pending:
+        predict_batch = predict_batch or _get_detector().predict_batch
+        batch_items = predict_batch([image for _, image, _ in pending])
+        for (index, _, image_hash), raw_items in zip(pending, batch_items):
+            results[index] = _post_filter_items(raw_items)
+            analysis_cache.put(keys[index], image_hash, results[index], owner)
+    return results
+
+
+def analyze_uploads(files, inference_socket=None, owner=None) -> list:
+    """
+    Analyze uploaded image files in this process, or on the inference server
+    listening on ``inference_socket`` (see ``ai_analyze.inference``).
+    ``owner`` (the uploading user's id) scopes near-duplicate cache hits.
+    Raises ``InvalidImageError`` for files that cannot be decoded.
+    """
+    blobs = [file.read() for file in files]
+    if inference_socket:
+        from .inference import InferenceClient
+
+        batch_items = InferenceClient(inference_socket).analyze_blobs(blobs, owner=owner)
+    else:
+        batch_items = analyze_blobs(blobs, owner=owner)
+    return [_summary(items) for items in batch_items]
@@ -0,0 +1,272 @@
+"""
+Local inference server that owns the YOLO model for every web worker:
+
+    python -m ai_analyze.inference --unix /tmp/moveline-inference.sock
+
+Web workers point ``AI_INFERENCE_SOCKET`` at it and send the uploaded image
+bytes; the server answers repeat photos from its analysis cache, decodes
+the rest and collects images from concurrent requests
+into micro-batches (up to ``--max-batch`` images, waiting at most
+``--max-delay-ms`` for a batch to fill) and runs each batch as one forward
+pass. Frames are a 4-byte big-endian length followed by a msgpack map.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import msgpack
+
+from .fastvlm_service import YOLO_MAX_BATCH, InvalidImageError, _get_detector, analyze_blobs, warm_up
+
+INFERENCE_BATCH_DELAY_MS = 10
+INFERENCE_TIMEOUT_SEC = 60.0
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+# Web workers connect as the same user or group as the server.
+SOCKET_MODE = 0o660
+
+_HEADER = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceError(Exception):
+    pass
+
+
+class MicroBatcher:
+    """
+    Queue of images from any number of requests, run through
+    ``predict_batch`` in batches on a single model thread.
+    """
+
+    def __init__(self, predict_batch, max_batch=YOLO_MAX_BATCH, max_delay=INFERENCE_BATCH_DELAY_MS / 1000):
+        self.predict_batch = predict_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = deque()
+        self._arrived = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._task = None
+
+    async def submit(self, images) -> list:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        futures = [loop.create_future() for _ in images]
+        self.pending.extend((image, future, now) for image, future in zip(images, futures))
+        self._arrived.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await asyncio.gather(*futures)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self._arrived.clear()
+                await self._arrived.wait()
+            # Wait for the batch to fill, but never keep the oldest image
+            # longer than max_delay.
+            deadline = self.pending[0][2] + self.max_delay
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = []
+            while self.pending and len(batch) < self.max_batch:
+                image, future, _ = self.pending.popleft()
+                # Images of requests that already timed out are skipped.
+                if not future.done():
+                    batch.append((image, future))
+            if not batch:
+                continue
+            images = [image for image, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.predict_batch, images)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(InferenceError(str(exc)))
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+
+async def read_frame(reader) -> bytes:
+    (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if size > MAX_FRAME_BYTES:
+        raise InferenceError("Frame too large.")
+    return await reader.readexactly(size)
+
+
+def _frame(message) -> bytes:
+    data = msgpack.packb(message)
+    return _HEADER.pack(len(data)) + data
+
+
+class InferenceServer:
+    def __init__(self, batcher, timeout=INFERENCE_TIMEOUT_SEC):
+        self.batcher = batcher
+        self.timeout = timeout
+
+    def _predict_batch(self, loop):
+        # analyze_blobs runs on an executor thread; its cache misses are
+        # handed back to the loop to join the shared micro-batches. By the
+        # timeout the client has given up, so its queued images are
+        # cancelled rather than run.
+        def predict_batch(images):
+            future = asyncio.run_coroutine_threadsafe(self.batcher.submit(images), loop)
+            try:
+                return future.result(self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise InferenceError("Inference timed out.") from None
+
+        return predict_batch
+
+    async def _reply(self, frame) -> dict:
+        loop = asyncio.get_running_loop()
+        try:
+            request = msgpack.unpackb(frame)
+            if not isinstance(request, dict):
+                raise InferenceError("Malformed request.")
+            if request.get("ping"):
+                return {"ok": True}
+            results = await loop.run_in_executor(
+                None, analyze_blobs, request.get("images") or [], self._predict_batch(loop), request.get("owner")
+            )
+        except InvalidImageError as exc:
+            return {"error": str(exc), "invalid": True}
+        except InferenceError as exc:
+            return {"error": str(exc)}
+        except Exception as exc:
+            logger.exception("Inference request failed")
+            return {"error": f"Inference failed: {exc}"}
+        return {"results": results}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                writer.write(_frame(await self._reply(frame)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, InferenceError):
+            pass
+        finally:
+            writer.close()
+
+
+def _is_listening(unix_path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(unix_path)
+        except OSError:
+            return False
+    return True
+
+
+async def start_server(batcher, unix_path, timeout=INFERENCE_TIMEOUT_SEC):
+    # A socket file nobody answers on is left over from a crashed server;
+    # a live one belongs to another server that must keep it.
+    if os.path.exists(unix_path):
+        if _is_listening(unix_path):
+            raise InferenceError(f"An inference server is already listening on {unix_path}.")
+        os.remove(unix_path)
+    server = await asyncio.start_unix_server(InferenceServer(batcher, timeout).handle, path=unix_path)
+    os.chmod(unix_path, SOCKET_MODE)
+    return server
+
+
+async def serve(unix_path, max_batch=YOLO_MAX_BATCH, max_delay=INFERENCE_BATCH_DELAY_MS / 1000):
+    batcher = MicroBatcher(_get_detector().predict_batch, max_batch=max_batch, max_delay=max_delay)
+    server = await start_server(batcher, unix_path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.close()
+
+
+class InferenceClient:
+    """
+    Blocking client for request threads. Each call uses its own short-lived
+    unix socket connection, so one client can be shared across threads.
+    """
+
+    def __init__(self, path, timeout=INFERENCE_TIMEOUT_SEC):
+        self.path = path
+        self.timeout = timeout
+
+    def _call(self, message):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(_frame(message))
+            (size,) = _HEADER.unpack(self._recv_exactly(sock, _HEADER.size))
+            return msgpack.unpackb(self._recv_exactly(sock, size))
+
+    @staticmethod
+    def _recv_exactly(sock, size) -> bytes:
+        chunks = []
+        while size:
+            chunk = sock.recv(min(size, 1024 * 1024))
+            if not chunk:
+                raise InferenceError("Inference server closed the connection.")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def analyze_blobs(self, images, owner=None) -> list:
+        """Post-filtered items per encoded image, as ``fastvlm_service.analyze_blobs``."""
+        reply = self._call({"images": list(images), "owner": owner})
+        if "error" in reply:
+            if reply.get("invalid"):
+                raise InvalidImageError(reply["error"])
+            raise InferenceError(reply["error"])
+        return reply["results"]
+
+    def ping(self) -> bool:
+        try:
+            return bool(self._call({"ping": True}).get("ok"))
+        except (OSError, InferenceError):
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local YOLO inference server for MoveLine.")
+    parser.add_argument("--unix", required=True, help="Unix domain socket path to listen on.")
+    parser.add_argument("--max-batch", type=int, default=YOLO_MAX_BATCH)
+    parser.add_argument("--max-delay-ms", type=float, default=INFERENCE_BATCH_DELAY_MS)
+    args = parser.parse_args()
+    # Load and warm the model before accepting work so clients only see a
+    # ready server.
+    warm_up()
+    print(f"MoveLine inference server listening on {args.unix}")
+    try:
+        asyncio.run(serve(args.unix, max_batch=args.max_batch, max_delay=args.max_delay_ms / 1000))
+    except InferenceError as exc:
+        parser.exit(1, f"{exc}\n")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
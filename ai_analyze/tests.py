@@ -1,3 +1,304 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import random
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.test import SimpleTestCase
+from PIL import Image
+
+from . import fastvlm_service
+from .cache import AnalysisCache
+from .fastvlm_service import HybridMoveLineDetector, InvalidImageError, analysis_cache
+from .inference import InferenceClient, InferenceError, MicroBatcher, start_server
+
+# Generous enough for a loaded CI box; ultralytics + torch alone take longer.
+STARTUP_IMPORT_BUDGET_SEC = 3.0
+HEAVY_MODULES = ("ultralytics", "torch")
+
+STARTUP_SCRIPT = """
+import os, sys, time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "moveline.settings")
+started = time.perf_counter()
+import django
+django.setup()
+import moveline.urls
+print(time.perf_counter() - started)
+print(",".join(name for name in {modules!r} if name in sys.modules))
+"""
+
+
+class StartupImportTest(SimpleTestCase):
+    def test_url_conf_loads_without_ml_stack(self):
+        env = {key: value for key, value in os.environ.items() if key != "DJANGO_SETTINGS_MODULE"}
+        env["PYTHONPATH"] = str(settings.BASE_DIR)
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT.format(modules=HEAVY_MODULES)],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=60,
+            env=env,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        elapsed, loaded = result.stdout.splitlines()[-2:]
+        self.assertEqual(loaded, "", f"imported at startup: {loaded}")
+        self.assertLess(float(elapsed), STARTUP_IMPORT_BUDGET_SEC)
+
+
+class EagerWarmupTest(SimpleTestCase):
+    def _ready(self, argv, run_main=None, socket=None):
+        env = {"RUN_MAIN": run_main} if run_main else {}
+        with mock.patch.object(sys, "argv", argv), mock.patch.dict(os.environ, env), self.settings(
+            AI_EAGER_WARMUP=True, AI_INFERENCE_SOCKET=socket
+        ), mock.patch.object(fastvlm_service, "start_warmup") as start_warmup:
+            apps.get_app_config("ai_analyze").ready()
+        return start_warmup.called
+
+    def test_warms_up_only_in_serving_processes(self):
+        self.assertTrue(self._ready(["gunicorn", "moveline.wsgi"]))
+        self.assertTrue(self._ready(["manage.py", "runserver"], run_main="true"))
+        self.assertFalse(self._ready(["manage.py", "runserver"]))
+        self.assertFalse(self._ready(["manage.py", "migrate"]))
+        self.assertFalse(self._ready(["manage.py", "collectstatic", "--noinput"]))
+        self.assertFalse(self._ready(["daphne", "moveline.asgi:application"], socket="/tmp/inference.sock"))
+
+
+class _FakeYolo:
+    def __init__(self, labels):
+        self.labels = labels
+        self.batches = []
+
+    def __call__(self, images, conf, verbose):
+        self.batches.append(len(images))
+        names = dict(enumerate(self.labels))
+        boxes = SimpleNamespace(cls=SimpleNamespace(tolist=lambda: list(names)))
+        return [SimpleNamespace(names=names, boxes=boxes) for _ in images]
+
+
+class BatchedAnalyzeTest(SimpleTestCase):
+    def setUp(self):
+        self.detector = HybridMoveLineDetector.__new__(HybridMoveLineDetector)
+        self.detector.yolo = _FakeYolo(["couch", "chair", "person"])
+        self.addCleanup(setattr, fastvlm_service, "_detector", fastvlm_service._detector)
+        fastvlm_service._detector = self.detector
+        analysis_cache.clear()
+        self.addCleanup(analysis_cache.clear)
+
+    def test_images_run_in_batches_of_max_size(self):
+        blobs = [_jpeg_bytes(seed) for seed in range(fastvlm_service.YOLO_MAX_BATCH + 2)]
+        results = fastvlm_service.analyze_blobs(blobs)
+
+        self.assertEqual(self.detector.yolo.batches, [fastvlm_service.YOLO_MAX_BATCH, 2])
+        self.assertEqual(len(results), len(blobs))
+        self.assertEqual([item["label"] for item in results[0]], ["Chair", "Sofa"])
+
+    def test_warm_up_reports_ready(self):
+        fastvlm_service._warm.clear()
+        self.addCleanup(fastvlm_service._warm.clear)
+        self.assertFalse(fastvlm_service.readiness()["ready"])
+        fastvlm_service.warm_up()
+        self.assertEqual(fastvlm_service.readiness(), {"ready": True, "error": None})
+
+
+def _jpeg_bytes(seed, size=(64, 64), quality=90):
+    rng = random.Random(seed)
+    image = Image.frombytes("L", (8, 8), bytes(rng.randrange(256) for _ in range(64))).resize(size).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _strip_bytes(flip):
+    ramp = bytes(range(0, 256, 32))
+    rows = [ramp[::-1], ramp] if flip else [ramp, ramp[::-1]]
+    image = Image.frombytes("L", (8, 2), b"".join(rows)).resize((640, 8), Image.NEAREST).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class InferenceServerTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        analysis_cache.clear()
+        self.addCleanup(analysis_cache.clear)
+
+    def _predict_batch(self, images):
+        self.batches.append(len(images))
+        return [[{"label": "couch", "quantity": 1, "is_fragile": False}] for _ in images]
+
+    async def test_concurrent_requests_share_a_batch(self):
+        batcher = MicroBatcher(self._predict_batch, max_batch=4, max_delay=0.05)
+        results = await asyncio.gather(*(batcher.submit(["image"] * count) for count in (1, 2, 3)))
+        batcher.close()
+
+        self.assertEqual([len(result) for result in results], [1, 2, 3])
+        self.assertEqual(self.batches, [4, 2])
+
+    async def test_client_round_trip(self):
+        batcher = MicroBatcher(self._predict_batch, max_batch=3, max_delay=1.0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inference.sock")
+            server = await start_server(batcher, path)
+            client = InferenceClient(path, timeout=5)
+            try:
+                self.assertTrue(await asyncio.to_thread(client.ping))
+                first, second = await asyncio.gather(
+                    asyncio.to_thread(client.analyze_blobs, [_jpeg_bytes(1)]),
+                    asyncio.to_thread(client.analyze_blobs, [_jpeg_bytes(2), _jpeg_bytes(3)]),
+                )
+                with self.assertRaises(InvalidImageError):
+                    await asyncio.to_thread(client.analyze_blobs, [b"not an image"])
+            finally:
+                server.close()
+                await server.wait_closed()
+                batcher.close()
+
+        self.assertEqual((len(first), len(second)), (1, 2))
+        self.assertEqual(second[0], [{"label": "Sofa", "quantity": 1, "is_fragile": False}])
+        self.assertEqual(self.batches, [3])
+
+    async def test_bad_requests_get_an_error_reply(self):
+        batcher = MicroBatcher(self._predict_batch)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inference.sock")
+            server = await start_server(batcher, path)
+            client = InferenceClient(path, timeout=5)
+            try:
+                with self.assertLogs("ai_analyze.inference", "ERROR") as logs:
+                    replies = [
+                        await asyncio.to_thread(client._call, message)
+                        for message in (["images"], {"images": 3}, {"images": [3]}, {"ping": True})
+                    ]
+            finally:
+                server.close()
+                await server.wait_closed()
+                batcher.close()
+
+        self.assertEqual(replies[0], {"error": "Malformed request."})
+        self.assertEqual([sorted(reply) for reply in replies[1:3]], [["error"], ["error"]])
+        self.assertTrue(replies[1]["error"].startswith("Inference failed"))
+        self.assertEqual(replies[3], {"ok": True})
+        self.assertEqual(len(logs.records), 2)
+
+    async def test_socket_is_private_and_never_taken_from_a_live_server(self):
+        batcher = MicroBatcher(self._predict_batch)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inference.sock")
+            # A socket file left behind by a crashed server is replaced.
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+                stale.bind(path)
+            server = await start_server(batcher, path)
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+                with self.assertRaises(InferenceError):
+                    await start_server(batcher, path)
+                alive = await asyncio.to_thread(InferenceClient(path, timeout=5).ping)
+            finally:
+                server.close()
+                await server.wait_closed()
+                batcher.close()
+
+        self.assertEqual(mode, 0o660)
+        self.assertTrue(alive)
+
+    async def test_timed_out_requests_leave_the_queue(self):
+        release = threading.Event()
+
+        def predict_batch(images):
+            release.wait(5)
+            return self._predict_batch(images)
+
+        batcher = MicroBatcher(predict_batch, max_batch=1, max_delay=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "inference.sock")
+            server = await start_server(batcher, path, timeout=0.3)
+            client = InferenceClient(path, timeout=5)
+            try:
+                # The first image holds the model; the second waits behind it.
+                outcomes = await asyncio.gather(
+                    asyncio.to_thread(client.analyze_blobs, [_jpeg_bytes(1)]),
+                    asyncio.to_thread(client.analyze_blobs, [_jpeg_bytes(2)]),
+                    return_exceptions=True,
+                )
+                release.set()
+                await asyncio.sleep(0.1)
+            finally:
+                server.close()
+                await server.wait_closed()
+                batcher.close()
+
+        self.assertEqual([type(outcome) for outcome in outcomes], [InferenceError, InferenceError])
+        self.assertEqual(self.batches, [1])
+        self.assertFalse(batcher.pending)
+
+
+class AnalysisCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        analysis_cache.clear()
+        self.addCleanup(analysis_cache.clear)
+
+    def _predict_batch(self, images):
+        self.batches.append(len(images))
+        return [[{"label": "chair", "quantity": 2}] for _ in images]
+
+    def test_repeat_and_reencoded_uploads_skip_inference(self):
+        first = fastvlm_service.analyze_blobs([_jpeg_bytes(1), _jpeg_bytes(2)], self._predict_batch, owner=1)
+        again = fastvlm_service.analyze_blobs(
+            [_jpeg_bytes(1), _jpeg_bytes(2, size=(60, 60), quality=70), _jpeg_bytes(3)], self._predict_batch, owner=1
+        )
+
+        self.assertEqual(self.batches, [2, 1])
+        self.assertEqual(first[0], [{"label": "Chair", "quantity": 2, "is_fragile": False}])
+        self.assertEqual(again, first + first[:1])
+
+    def test_near_matches_stay_with_their_owner(self):
+        fastvlm_service.analyze_blobs([_jpeg_bytes(2)], self._predict_batch, owner=1)
+        fastvlm_service.analyze_blobs([_jpeg_bytes(2)], self._predict_batch, owner=2)
+        fastvlm_service.analyze_blobs([_jpeg_bytes(2, size=(60, 60), quality=70)], self._predict_batch, owner=2)
+        fastvlm_service.analyze_blobs([_jpeg_bytes(2, size=(60, 60), quality=70)], self._predict_batch)
+
+        # Same bytes hit for anyone; a re-encoded copy only for its owner.
+        self.assertEqual(self.batches, [1, 1])
+
+    def test_different_photos_of_the_same_shape_miss(self):
+        # Thin strips whose rows are swapped: letterboxed to 640x640 they
+        # have the same difference hash, but the photos are unrelated.
+        for flip in (False, True):
+            fastvlm_service.analyze_blobs([_strip_bytes(flip)], self._predict_batch, owner=1)
+        self.assertEqual(self.batches, [1, 1])
+
+    def test_entries_expire(self):
+        cache = AnalysisCache(ttl_sec=0)
+        cache.put(b"key", 0, [], owner=1)
+        self.assertIsNone(cache.get(b"key"))
+        self.assertIsNone(cache.get_similar(0, owner=1))
+
+
+class DecodeImageTest(SimpleTestCase):
+    def test_large_jpeg_is_oriented_and_letterboxed(self):
+        photo = Image.new("RGB", (4000, 3000), (200, 30, 30))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # stored sideways, displayed rotated by 90 degrees
+        buffer = io.BytesIO()
+        photo.save(buffer, format="JPEG", exif=exif)
+        buffer.seek(0)
+
+        (image,) = fastvlm_service.decode_images([buffer])
+
+        self.assertEqual((image.mode, image.size), ("RGB", (640, 640)))
+        # Portrait after rotation: 480x640 content with padding left and right.
+        self.assertEqual(image.getpixel((70, 320)), fastvlm_service.LETTERBOX_FILL)
+        self.assertEqual(image.getpixel((570, 320)), fastvlm_service.LETTERBOX_FILL)
+        self.assertGreater(image.getpixel((90, 320))[0], 150)
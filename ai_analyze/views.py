@@ -1,4 +1,4 @@
-from PIL import Image
+from django.conf import settings
 from rest_framework import permissions, response, status, viewsets
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.views import APIView
@@ -6,8 +6,10 @@ from rest_framework.views import APIView
 from .models import OrderItem
 from .serializers import OrderItemSerializer
 from .fastvlm_service import (
-    analyze_image,
+    InvalidImageError,
+    analyze_uploads,
     estimate_total_volume_m3,
+    readiness,
     recommend_vehicle_type,
 )
 
@@ -31,24 +33,21 @@ class AnalyzeImageView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        all_items = {}
-        for image in images:
-            try:
-                pil_image = Image.open(image).convert("RGB")
-            except Exception:
-                return response.Response(
-                    {"detail": "Invalid image file."},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
-            try:
-                result = analyze_image(pil_image)
-            except Exception as exc:
-                return response.Response(
-                    {"detail": "Local inference failed.", "error": str(exc)},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                )
+        try:
+            results = analyze_uploads(images, inference_socket=settings.AI_INFERENCE_SOCKET, owner=request.user.pk)
+        except InvalidImageError:
+            return response.Response(
+                {"detail": "Invalid image file."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except Exception as exc:
+            return response.Response(
+                {"detail": "Local inference failed.", "error": str(exc)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
 
+        all_items = {}
+        for result in results:
             for item in result.get("items", []):
                 label = item.get("label")
                 if not label:
@@ -77,3 +76,28 @@ class AnalyzeImageView(APIView):
 
     def patch(self, request):
         return self.post(request)
+
+
+class AnalyzeReadyView(APIView):
+    """
+    Readiness probe for load balancers. With ``AI_INFERENCE_SOCKET`` it
+    answers 503 while the inference server is unreachable; with
+    ``AI_EAGER_WARMUP`` until the local model has been loaded and warmed.
+    Otherwise the model loads on first use and the worker is always ready.
+    """
+
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        if settings.AI_INFERENCE_SOCKET:
+            from .inference import InferenceClient
+
+            ready = InferenceClient(settings.AI_INFERENCE_SOCKET, timeout=2).ping()
+            code = status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+            return response.Response({"ready": ready, "remote": True}, status=code)
+        if not settings.AI_EAGER_WARMUP:
+            return response.Response({"ready": True, "eager": False}, status=status.HTTP_200_OK)
+        payload = dict(readiness(), eager=True)
+        code = status.HTTP_200_OK if payload["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE
+        return response.Response(payload, status=code)
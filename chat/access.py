@@ -0,0 +1,27 @@
+from django.db.models import Q
+
+from orders.models import Order
+
+
+def _participant_check(user, order_id):
+    # Decided by the user alone, or else the query that decides it.
+    if user is None or not user.is_authenticated:
+        return False
+    if user.is_staff or user.role == user.Role.ADMIN:
+        return True
+    return Order.objects.filter(Q(customer=user) | Q(driver=user) | Q(workers=user), pk=order_id)
+
+
+def is_participant(user, order_id):
+    """
+    Whether ``user`` may read and write the chat of an order: its customer,
+    driver and workers, and staff. Runs at most one query.
+    """
+    check = _participant_check(user, order_id)
+    return check if isinstance(check, bool) else check.exists()
+
+
+async def ais_participant(user, order_id):
+    """Async version of ``is_participant``."""
+    check = _participant_check(user, order_id)
+    return check if isinstance(check, bool) else await check.aexists()
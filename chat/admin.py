@@ -0,0 +1,9 @@
+from django.contrib import admin
+
+from .models import ChatMessage
+
+
+@admin.register(ChatMessage)
+class ChatMessageAdmin(admin.ModelAdmin):
+    list_display = ("order", "sender", "sent_at")
+    search_fields = ("order__id", "sender__username", "body")
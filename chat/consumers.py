@@ -1,41 +1,252 @@
+import asyncio
 import json
+import sys
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.utils import timezone
 
+from moveline import metrics
+from moveline.outbound import OutboundQueueMixin
+from moveline.replay import RecentList
+from orders.models import Order
+
+from .access import ais_participant
+from .models import ChatMessage
+from .writer import get_writer
+
+CHAT_RECENT_MESSAGES = 50
+CHAT_INBOX_GROUP = "chat_inbox"
+INBOX_REFRESH_INTERVAL_SEC = 30.0
+INBOX_MAX_ORDERS = 2000
+INBOX_DEFAULT_STATUSES = tuple(
+    status for status in Order.Status.values if status not in {Order.Status.COMPLETED, Order.Status.CANCELLED}
+)
+
+# Last messages per order, replayed on connect. They are kept in the channel
+# layer's broker, so every worker process serves the same list; only a cold
+# order (idle past the TTL) reads the database. Older history is paged
+# through /api/chat-messages/.
+recent_messages = RecentList("chat", size=CHAT_RECENT_MESSAGES)
+
+
+async def recent_chat_messages(layer, order_id):
+    """The recent messages of an order, loading them once when cold."""
+    messages = await recent_messages.get(layer, order_id)
+    if messages is None:
+        messages = await _load_recent(order_id)
+        await recent_messages.prime(layer, order_id, messages)
+        metrics.increment("chat.recent.loaded")
+    return messages
+
+
+async def _load_recent(order_id):
+    messages = ChatMessage.objects.filter(order_id=order_id).order_by("-sent_at", "-id")[:CHAT_RECENT_MESSAGES]
+    payloads = [
+        {
+            "order": message.order_id,
+            "sender": message.sender_id,
+            "message": message.body,
+            "sent_at": message.sent_at.isoformat(),
+        }
+        async for message in messages
+    ]
+    payloads.reverse()
+    return payloads
+
+
+class ChatConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
+    # Chat messages cannot be skipped silently; a client that falls this far
+    # behind is disconnected and has to reconnect.
+    outbound_limit = 256
+    outbound_drop_oldest = False
+    outbound_metrics_prefix = "chat"
+
+    joined = False
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
-        self.group_name = f"chat_{self.order_id}"
+        self.order_id = sys.intern(self.scope["url_route"]["kwargs"]["order_id"])
+        self.group_name = sys.intern(f"chat_{self.order_id}")
+        metrics.ensure_loop_monitor(self.channel_layer)
+        if not await ais_participant(self.scope.get("user"), self.order_id):
+            await self.close(code=4003)
+            return
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.joined = True
         await self.accept()
+        get_writer().attach()
+
+        messages = await recent_chat_messages(self.channel_layer, self.order_id)
+        await self.send(text_data=json.dumps({"type": "history", "messages": messages}, ensure_ascii=False))
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if self.joined:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            # The last socket of a worker stopping must not take unsaved
+            # messages with it.
+            await get_writer().detach()
 
     async def receive(self, text_data=None, bytes_data=None):
         if not text_data:
             return
-        payload = json.loads(text_data)
-        message = payload.get("message")
-        if not message:
+        with metrics.timer("chat.receive"):
+            await self._handle_message(text_data)
+
+    async def _handle_message(self, text_data):
+        with metrics.timer("chat.receive.parse"):
+            payload = json.loads(text_data)
+        message = payload.get("message") if isinstance(payload, dict) else None
+        if not message or not isinstance(message, str):
             return
 
+        sender_id = self.scope["user"].pk
+        sent_at = timezone.now()
         outgoing = {
             "order": int(self.order_id),
+            "sender": sender_id,
             "message": message,
-            "sent_at": timezone.now().isoformat(),
+            "sent_at": sent_at.isoformat(),
         }
-
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                "type": "chat.message",
-                "payload": outgoing,
-            },
+        # Stored in the background by the batch writer; see chat.writer.
+        await get_writer().add(
+            ChatMessage(order_id=outgoing["order"], sender_id=sender_id, body=message, sent_at=sent_at)
         )
 
+        with metrics.timer("chat.receive.group_send"):
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    "type": "chat.message",
+                    "payload": outgoing,
+                },
+            )
+            await self.channel_layer.group_send(CHAT_INBOX_GROUP, {"type": "chat.notification", "payload": outgoing})
+        await recent_messages.push(self.channel_layer, self.order_id, outgoing)
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event["payload"], ensure_ascii=False))
+        await self.queue_send(text_data=json.dumps(event["payload"], ensure_ascii=False))
+
+
+class InboxConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
+    """
+    One socket per support agent covering the chats of many orders.
+
+    ``{"action": "subscribe", "office": 3, "status": ["assigned"], "agent": "me"}``
+    (every filter optional; active orders by default) selects the orders to
+    watch and is answered with ``inbox.snapshot``. Every chat message of a
+    watched order arrives as ``inbox.message`` with the order's unread count,
+    kept in memory per connection. ``{"action": "history", "order": id}``
+    returns the recent messages and marks the order read; ``{"action":
+    "read", "order": id}`` only marks it read. Older pages come from
+    /api/chat-messages/.
+
+    The socket stays in the single ``chat_inbox`` group and filters by order
+    id locally; the watched orders are re-queried every
+    ``INBOX_REFRESH_INTERVAL_SEC`` so new and finished orders come and go.
+    """
+
+    outbound_limit = 512
+    outbound_drop_oldest = False
+    outbound_metrics_prefix = "chat.inbox"
+
+    filters = None
+    refresh_task = None
+
+    async def connect(self):
+        user = self.scope.get("user")
+        if not (user and user.is_authenticated and (user.is_staff or user.role == user.Role.ADMIN)):
+            await self.close(code=4003)
+            return
+
+        self.unread = {}
+        await self.channel_layer.group_add(CHAT_INBOX_GROUP, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        await self.channel_layer.group_discard(CHAT_INBOX_GROUP, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            payload = json.loads(text_data)
+        except ValueError:
+            return
+        action = payload.get("action") if isinstance(payload, dict) else None
+        if action == "subscribe":
+            await self._subscribe(payload)
+            return
+        if action not in ("history", "read"):
+            return
+        try:
+            order = int(payload["order"])
+        except (KeyError, TypeError, ValueError):
+            order = None
+        if order not in self.unread:
+            await self.send(text_data=json.dumps({"type": "error", "detail": "Unknown order."}))
+            return
+        self.unread[order] = 0
+        if action == "history":
+            # Served from the same recent list the chat senders push to, so
+            # it includes every message this socket was notified about.
+            messages = await recent_chat_messages(self.channel_layer, str(order))
+            await self.send(
+                text_data=json.dumps({"type": "history", "order": order, "messages": messages}, ensure_ascii=False)
+            )
+
+    async def _subscribe(self, payload):
+        filters = {"status__in": INBOX_DEFAULT_STATUSES}
+        try:
+            if payload.get("office") is not None:
+                filters["vehicle__office_id"] = int(payload["office"])
+            if payload.get("status") is not None:
+                statuses = payload["status"]
+                statuses = [statuses] if isinstance(statuses, str) else list(statuses)
+                if not statuses or any(status not in Order.Status.values for status in statuses):
+                    raise ValueError
+                filters["status__in"] = statuses
+            agent = payload.get("agent")
+            if agent == "me":
+                filters["support_agent_id"] = self.scope["user"].pk
+            elif agent is not None:
+                filters["support_agent_id"] = int(agent)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({"type": "error", "detail": "Invalid subscription."}))
+            return
+
+        self.filters = filters
+        await self._refresh()
+        orders = [{"order": order, "unread": unread} for order, unread in self.unread.items()]
+        await self.send(text_data=json.dumps({"type": "inbox.snapshot", "orders": orders}))
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_forever())
+
+    async def _refresh(self):
+        order_ids = await self._matching_orders(self.filters)
+        # Counters of orders that still match survive a refresh or re-subscribe.
+        self.unread = {order: self.unread.get(order, 0) for order in order_ids}
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(INBOX_REFRESH_INTERVAL_SEC)
+            await self._refresh()
+
+    async def _matching_orders(self, filters):
+        orders = Order.objects.filter(**filters).order_by("-updated_at").values_list("id", flat=True)
+        return [order async for order in orders[:INBOX_MAX_ORDERS]]
+
+    async def chat_notification(self, event):
+        payload = event["payload"]
+        order = payload["order"]
+        if order not in self.unread:
+            return
+        if payload["sender"] != self.scope["user"].pk:
+            self.unread[order] += 1
+        await self.queue_send(
+            text_data=json.dumps(
+                {"type": "inbox.message", "order": order, "unread": self.unread[order], "message": payload},
+                ensure_ascii=False,
+            )
+        )
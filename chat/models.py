@@ -0,0 +1,24 @@
+from django.db import models
+from django.utils import timezone
+
+
+class ChatMessage(models.Model):
+    order = models.ForeignKey("orders.Order", on_delete=models.CASCADE, related_name="chat_messages")
+    sender = models.ForeignKey(
+        "users.User",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="chat_messages",
+    )
+    body = models.TextField()
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ("sent_at", "id")
+        indexes = [
+            models.Index(fields=("order", "sent_at", "id"), name="chat_order_sent_idx"),
+        ]
+
+    def __str__(self) -> str:  # pragma: no cover - human readable string
+        return f"ChatMessage(order={self.order_id}, at={self.sent_at})"
@@ -0,0 +1,11 @@
+from rest_framework import serializers
+
+from .models import ChatMessage
+
+
+class ChatMessageSerializer(serializers.ModelSerializer):
+    message = serializers.CharField(source="body")
+
+    class Meta:
+        model = ChatMessage
+        fields = ("id", "order", "sender", "message", "sent_at")
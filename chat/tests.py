@@ -0,0 +1,198 @@
+from datetime import timedelta
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from moveline import metrics
+from orders.models import Order
+from .consumers import recent_messages
+from .models import ChatMessage
+from .routing import websocket_urlpatterns
+from .views import ChatMessageViewSet
+from .writer import ChatMessageWriter, get_writer
+
+
+class ChatTestMixin:
+    def setUp(self):
+        User = get_user_model()
+        self.customer = User.objects.create_user(username="customer", password="pass")
+        self.driver = User.objects.create_user(username="driver", password="pass", role=User.Role.DRIVER)
+        self.order = Order.objects.create(
+            customer=self.customer,
+            driver=self.driver,
+            service_type=Order.ServiceType.MOVING,
+            pickup_address="Damascus",
+        )
+        recent_messages.discard(str(self.order.id))
+
+    def _communicator(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.order.id}/")
+        communicator.scope["user"] = user
+        return communicator
+
+
+class ChatConsumerTest(ChatTestMixin, TestCase):
+    async def test_messages_are_relayed_and_stored_in_one_batch(self):
+        customer = self._communicator(self.customer)
+        driver = self._communicator(self.driver)
+        await customer.connect()
+        await driver.connect()
+        for communicator in (customer, driver):
+            self.assertEqual(await communicator.receive_json_from(), {"type": "history", "messages": []})
+        metrics.reset()
+
+        await customer.send_json_to({"message": "Hello"})
+        self.assertEqual((await driver.receive_json_from())["message"], "Hello")
+        await driver.send_json_to({"message": "On my way"})
+        self.assertEqual((await driver.receive_json_from())["sender"], self.driver.pk)
+        self.assertEqual([(await customer.receive_json_from())["message"] for _ in range(2)], ["Hello", "On my way"])
+
+        await get_writer().flush()
+        stored = [message async for message in ChatMessage.objects.filter(order=self.order).values_list("sender_id", "body")]
+        self.assertEqual(stored, [(self.customer.pk, "Hello"), (self.driver.pk, "On my way")])
+        self.assertEqual(metrics.snapshot()["counters"]["chat.write.db_queries"], 1)
+        await customer.disconnect()
+        await driver.disconnect()
+
+    async def test_last_disconnect_stores_pending_messages(self):
+        writer = get_writer()
+        self.addCleanup(setattr, writer, "interval", writer.interval)
+        writer.interval = 60
+        customer = self._communicator(self.customer)
+        await customer.connect()
+        await customer.receive_json_from()
+        await customer.send_json_to({"message": "Hello"})
+        await customer.receive_json_from()
+        self.assertFalse(await ChatMessage.objects.filter(order=self.order).aexists())
+
+        await customer.disconnect()
+        self.assertEqual(await ChatMessage.objects.filter(order=self.order).acount(), 1)
+
+    async def test_full_writer_holds_the_sender_until_it_flushed(self):
+        writer = ChatMessageWriter(interval=60)
+        with mock.patch("chat.writer.CHAT_WRITE_MAX_PENDING", 1):
+            for body in ("one", "two"):
+                await writer.add(ChatMessage(order=self.order, sender=self.customer, body=body))
+        self.assertEqual([message.body for message in writer.pending], ["two"])
+        self.assertEqual(await ChatMessage.objects.filter(order=self.order).acount(), 1)
+        await writer.flush()
+
+    async def test_recent_messages_are_replayed_from_memory(self):
+        await ChatMessage.objects.acreate(order=self.order, sender=self.customer, body="Stored earlier")
+        customer = self._communicator(self.customer)
+        await customer.connect()
+        history = await customer.receive_json_from()
+        self.assertEqual([message["message"] for message in history["messages"]], ["Stored earlier"])
+        await customer.send_json_to({"message": "Hello"})
+        await customer.receive_json_from()
+
+        metrics.reset()
+        driver = self._communicator(self.driver)
+        await driver.connect()
+        history = await driver.receive_json_from()
+        self.assertEqual([message["message"] for message in history["messages"]], ["Stored earlier", "Hello"])
+        self.assertNotIn("chat.recent.loaded", metrics.snapshot()["counters"])
+        await customer.disconnect()
+        await driver.disconnect()
+
+    async def test_outsiders_cannot_connect(self):
+        User = get_user_model()
+        outsider = await User.objects.acreate_user(username="outsider", password="pass")
+        for user in (outsider, AnonymousUser()):
+            connected, code = await self._communicator(user).connect()
+            self.assertEqual((connected, code), (False, 4003))
+
+
+class InboxConsumerTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        self.agent = User.objects.create_user(username="agent", password="pass", is_staff=True)
+        self.order.support_agent = self.agent
+        self.order.save(update_fields=["support_agent"])
+        self.other_order = Order.objects.create(
+            customer=self.customer,
+            service_type=Order.ServiceType.CLEANING,
+            pickup_address="Homs",
+        )
+        recent_messages.discard(str(self.other_order.id))
+
+    def _inbox(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/inbox/")
+        communicator.scope["user"] = user
+        return communicator
+
+    async def test_notifications_count_unread_for_watched_orders(self):
+        inbox = self._inbox(self.agent)
+        connected, _ = await inbox.connect()
+        self.assertTrue(connected)
+        await inbox.send_json_to({"action": "subscribe", "agent": "me"})
+        snapshot = await inbox.receive_json_from()
+        self.assertEqual(snapshot, {"type": "inbox.snapshot", "orders": [{"order": self.order.id, "unread": 0}]})
+        await inbox.send_json_to({"action": "history", "order": self.order.id})
+        self.assertEqual((await inbox.receive_json_from())["messages"], [])
+
+        customer = self._communicator(self.customer)
+        await customer.connect()
+        await customer.receive_json_from()
+        for text in ("Hello", "Anyone?"):
+            await customer.send_json_to({"message": text})
+        notifications = [await inbox.receive_json_from() for _ in range(2)]
+        self.assertEqual([(note["order"], note["unread"]) for note in notifications], [(self.order.id, 1), (self.order.id, 2)])
+        self.assertEqual(notifications[1]["message"]["message"], "Anyone?")
+
+        other = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.other_order.id}/")
+        other.scope["user"] = self.customer
+        await other.connect()
+        await other.receive_json_from()
+        await other.send_json_to({"message": "Not watched"})
+        await other.receive_json_from()
+        self.assertTrue(await inbox.receive_nothing())
+
+        await inbox.send_json_to({"action": "history", "order": self.order.id})
+        history = await inbox.receive_json_from()
+        self.assertEqual([message["message"] for message in history["messages"]], ["Hello", "Anyone?"])
+        await inbox.send_json_to({"action": "subscribe", "agent": "me"})
+        self.assertEqual((await inbox.receive_json_from())["orders"], [{"order": self.order.id, "unread": 0}])
+
+        await get_writer().flush()
+        for communicator in (inbox, customer, other):
+            await communicator.disconnect()
+
+    async def test_requires_staff(self):
+        inbox = self._inbox(self.customer)
+        connected, code = await inbox.connect()
+        self.assertEqual((connected, code), (False, 4003))
+
+
+class ChatHistoryViewTest(ChatTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        ChatMessage.objects.bulk_create(
+            ChatMessage(order=self.order, sender=self.customer, body=f"m{index}", sent_at=now + timedelta(seconds=index))
+            for index in range(5)
+        )
+
+    def _get(self, user, query):
+        request = APIRequestFactory().get("/api/chat-messages/", query)
+        force_authenticate(request, user)
+        return ChatMessageViewSet.as_view({"get": "list"})(request)
+
+    def test_pages_newest_first(self):
+        first = self._get(self.driver, {"order": self.order.id, "page_size": 3})
+        self.assertEqual([message["message"] for message in first.data["results"]], ["m4", "m3", "m2"])
+        cursor = first.data["next"].split("cursor=")[1].split("&")[0]
+        second = self._get(self.driver, {"order": self.order.id, "page_size": 3, "cursor": cursor})
+        self.assertEqual([message["message"] for message in second.data["results"]], ["m1", "m0"])
+
+    def test_requires_participant(self):
+        outsider = get_user_model().objects.create_user(username="outsider", password="pass")
+        self.assertEqual(self._get(outsider, {"order": self.order.id}).status_code, 403)
+        self.assertEqual(self._get(self.customer, {}).status_code, 400)
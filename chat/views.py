@@ -0,0 +1,36 @@
+from rest_framework import exceptions, viewsets
+from rest_framework.pagination import CursorPagination
+
+from .access import is_participant
+from .models import ChatMessage
+from .serializers import ChatMessageSerializer
+
+
+class ChatHistoryPagination(CursorPagination):
+    # Newest first; served by the (order, sent_at, id) index.
+    ordering = ("-sent_at", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class ChatMessageViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Chat history for one order: ``/api/chat-messages/?order=<id>``. Only the
+    order's customer, driver, workers and staff can read it.
+    """
+
+    queryset = ChatMessage.objects.all()
+    serializer_class = ChatMessageSerializer
+    pagination_class = ChatHistoryPagination
+
+    def get_queryset(self):
+        order_id = self.request.query_params.get("order")
+        if not order_id or not order_id.isdigit():
+            raise exceptions.ValidationError({"order": "This query parameter is required."})
+        order_id = int(order_id)
+        # Membership is checked once so the history query stays a plain
+        # range scan on the (order, sent_at, id) index.
+        if not is_participant(self.request.user, order_id):
+            raise exceptions.PermissionDenied("You are not a participant of this order.")
+        return super().get_queryset().filter(order_id=order_id)
@@ -0,0 +1,114 @@
+"""
+Buffered persistence for chat messages.
+
+Consumers hand unsaved ``ChatMessage`` objects to the writer of their event
+loop; it collects them for up to ``CHAT_WRITE_INTERVAL_SEC`` (or until
+``CHAT_WRITE_BATCH_SIZE`` are pending) and stores them with one
+``bulk_create``, so a burst across many orders costs one INSERT per batch.
+Pending messages are written when the last chat consumer of the loop
+disconnects (as every socket does on a graceful shutdown) and at interpreter
+exit; only a crash loses them. A sender whose writer already holds
+``CHAT_WRITE_MAX_PENDING`` messages waits for a flush before its message is
+accepted.
+"""
+
+import asyncio
+import atexit
+import logging
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError
+
+from moveline import metrics
+
+from .models import ChatMessage
+
+CHAT_WRITE_INTERVAL_SEC = 0.5
+CHAT_WRITE_BATCH_SIZE = 200
+CHAT_WRITE_MAX_PENDING = 10000
+
+_writers = weakref.WeakKeyDictionary()
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageWriter:
+    def __init__(self, interval=CHAT_WRITE_INTERVAL_SEC, batch_size=CHAT_WRITE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.consumers = 0
+        self._full = asyncio.Event()
+        self._task = None
+
+    async def add(self, message):
+        if len(self.pending) >= CHAT_WRITE_MAX_PENDING:
+            # The database is behind; hold the sender rather than accept
+            # messages that might never be stored.
+            metrics.increment("chat.write.backpressure")
+            await self.flush()
+        self.pending.append(message)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        elif len(self.pending) >= self.batch_size:
+            self._full.set()
+
+    async def _run(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            await sync_to_async(_write)(batch)
+
+    def attach(self):
+        self.consumers += 1
+
+    async def detach(self):
+        self.consumers -= 1
+        if not self.consumers:
+            await self.flush()
+
+
+@metrics.counts_queries("chat.write.db_queries")
+def _write(batch):
+    try:
+        ChatMessage.objects.bulk_create(batch, batch_size=500)
+    except DatabaseError:
+        # One bad row (e.g. an order deleted meanwhile) must not cost the
+        # rest of the batch, so fall back to row-by-row inserts.
+        written = 0
+        for message in batch:
+            try:
+                message.save(force_insert=True)
+                written += 1
+            except DatabaseError:
+                logger.exception("Could not store chat message for order %s", message.order_id)
+                metrics.increment("chat.write.failed")
+        metrics.increment("chat.write.messages", written)
+        return
+    metrics.increment("chat.write.messages", len(batch))
+
+
+def get_writer():
+    """The writer for the running event loop."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = ChatMessageWriter()
+    return writer
+
+
+@atexit.register
+def _flush_at_exit():
+    for writer in list(_writers.values()):
+        batch, writer.pending = writer.pending, []
+        if batch:
+            _write(batch)
@@ -17,10 +17,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'moveline.settings')
 django_asgi_app = get_asgi_application()
 
 from moveline.routing import websocket_urlpatterns
+from users.middleware import JWTAuthMiddleware
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
-        "websocket": URLRouter(websocket_urlpatterns),
+        "websocket": JWTAuthMiddleware(URLRouter(websocket_urlpatterns)),
     }
 )
@@ -0,0 +1,316 @@
+"""
+Small local broker for ``moveline.layers.RespChannelLayer``.
+
+It implements the handful of Redis commands the channel layer needs (lists,
+sorted sets, expiry and blocking pops) so several ASGI workers on one host
+can share channels and groups without running Redis:
+
+    python -m moveline.broker --unix /tmp/moveline-channels.sock
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import os
+import time
+from collections import deque
+
+from .resp import RespError, encode_reply, read_reply
+
+SWEEP_INTERVAL_SEC = 1.0
+
+
+class Broker:
+    def __init__(self):
+        self.lists = {}
+        self.zsets = {}
+        self.expires = {}
+        self.waiters = {}
+
+    # ---------------------------------------------------------
+    # Keyspace helpers
+    # ---------------------------------------------------------
+    def _expired(self, key, now=None) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is None or deadline > (now or time.monotonic()):
+            return False
+        self._delete(key)
+        return True
+
+    def _delete(self, key) -> bool:
+        self.expires.pop(key, None)
+        found = self.lists.pop(key, None) is not None
+        return (self.zsets.pop(key, None) is not None) or found
+
+    def _list(self, key, create=False):
+        self._expired(key)
+        items = self.lists.get(key)
+        if items is None and create:
+            items = self.lists[key] = deque()
+        return items
+
+    def _zset(self, key, create=False):
+        self._expired(key)
+        members = self.zsets.get(key)
+        if members is None and create:
+            members = self.zsets[key] = {}
+        return members
+
+    def _pop(self, key):
+        items = self._list(key)
+        if not items:
+            return None
+        value = items.popleft()
+        if not items:
+            self._delete(key)
+        return value
+
+    def _wake(self, key):
+        waiters = self.waiters.get(key)
+        while waiters and self.lists.get(key):
+            future, reader = waiters.popleft()
+            # Never hand a message to a client that has already gone away.
+            if not future.done() and not (reader is not None and reader.at_eof()):
+                future.set_result([key, self._pop(key)])
+        if not waiters:
+            self.waiters.pop(key, None)
+
+    def release_waiters(self):
+        for waiters in self.waiters.values():
+            for future, _ in waiters:
+                if not future.done():
+                    future.set_result(None)
+        self.waiters.clear()
+
+    def sweep(self):
+        now = time.monotonic()
+        for key in [key for key, deadline in self.expires.items() if deadline <= now]:
+            self._delete(key)
+
+    # ---------------------------------------------------------
+    # Commands
+    # ---------------------------------------------------------
+    async def execute(self, args, reader=None):
+        if not args:
+            return RespError("ERR empty command")
+        name = args[0].decode("ascii", "replace").upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        try:
+            if name == "BLPOP":
+                return await self.cmd_blpop(*args[1:], reader=reader)
+            return handler(*args[1:])
+        except TypeError:
+            return RespError(f"ERR wrong number of arguments for '{name}' command")
+        except ValueError:
+            return RespError("ERR value is not a valid number")
+
+    def cmd_ping(self, message=None):
+        return "PONG" if message is None else message
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_del(self, *keys):
+        return sum(1 for key in keys if self._delete(key))
+
+    def cmd_expire(self, key, seconds):
+        if self._list(key) is None and self._zset(key) is None:
+            return 0
+        self.expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def cmd_keys(self, pattern):
+        self.sweep()
+        pattern = pattern.decode("utf-8")
+        keys = list(self.lists) + list(self.zsets)
+        return [key for key in keys if fnmatch.fnmatchcase(key.decode("utf-8"), pattern)]
+
+    def cmd_flushdb(self, *_):
+        self.lists.clear()
+        self.zsets.clear()
+        self.expires.clear()
+        return "OK"
+
+    def cmd_rpush(self, key, *values):
+        if not values:
+            raise TypeError
+        items = self._list(key, create=True)
+        items.extend(values)
+        length = len(items)
+        self._wake(key)
+        return length
+
+    def cmd_rpushx(self, key, *values):
+        if not values:
+            raise TypeError
+        if not self._list(key):
+            return 0
+        return self.cmd_rpush(key, *values)
+
+    def cmd_lrange(self, key, start, stop):
+        items = self._list(key)
+        if not items:
+            return []
+        start, stop = _index_range(len(items), start, stop)
+        return list(items)[start : stop + 1]
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._list(key)
+        if not items:
+            return "OK"
+        start, stop = _index_range(len(items), start, stop)
+        kept = list(items)[start : stop + 1] if start <= stop else []
+        if kept:
+            self.lists[key] = deque(kept)
+        else:
+            self._delete(key)
+        return "OK"
+
+    def cmd_lpop(self, key):
+        return self._pop(key)
+
+    def cmd_llen(self, key):
+        items = self._list(key)
+        return len(items) if items else 0
+
+    async def cmd_blpop(self, *args, reader=None):
+        if len(args) < 2:
+            raise TypeError
+        *keys, timeout = args
+        timeout = float(timeout)
+        for key in keys:
+            value = self._pop(key)
+            if value is not None:
+                return [key, value]
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, reader)
+        for key in keys:
+            self.waiters.setdefault(key, deque()).append(entry)
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for key in keys:
+                waiters = self.waiters.get(key)
+                if waiters and entry in waiters:
+                    waiters.remove(entry)
+                if not waiters:
+                    self.waiters.pop(key, None)
+
+    def cmd_zadd(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        members = self._zset(key, create=True)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self._zset(key)
+        if not zset:
+            return 0
+        removed = sum(1 for member in members if zset.pop(member, None) is not None)
+        if not zset:
+            self._delete(key)
+        return removed
+
+    def cmd_zcard(self, key):
+        zset = self._zset(key)
+        return len(zset) if zset else 0
+
+    def cmd_zrange(self, key, start, stop):
+        zset = self._zset(key)
+        if not zset:
+            return []
+        ordered = sorted(zset, key=zset.__getitem__)
+        start, stop = int(start), int(stop)
+        stop = len(ordered) if stop == -1 else stop + 1
+        return ordered[start:stop]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        zset = self._zset(key)
+        if not zset:
+            return 0
+        low, high = float(low), float(high)
+        stale = [member for member, score in zset.items() if low <= score <= high]
+        for member in stale:
+            del zset[member]
+        if not zset:
+            self._delete(key)
+        return len(stale)
+
+    # ---------------------------------------------------------
+    # Server
+    # ---------------------------------------------------------
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                args = await read_reply(reader)
+                if not isinstance(args, list):
+                    writer.write(encode_reply(RespError("ERR protocol error")))
+                    break
+                writer.write(encode_reply(await self.execute(args, reader=reader)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL_SEC)
+            self.sweep()
+
+
+def _index_range(length, start, stop):
+    # Redis list indexes: inclusive, negative ones count from the end.
+    start, stop = int(start), int(stop)
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop = length + stop
+    return start, min(stop, length - 1)
+
+
+async def start_server(broker, unix_path=None, host="127.0.0.1", port=None):
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        return await asyncio.start_unix_server(broker.handle, path=unix_path)
+    return await asyncio.start_server(broker.handle, host=host, port=port)
+
+
+async def serve(unix_path=None, host="127.0.0.1", port=None):
+    broker = Broker()
+    server = await start_server(broker, unix_path=unix_path, host=host, port=port)
+    sweeper = asyncio.create_task(broker._sweep_forever())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        sweeper.cancel()
+        broker.release_waiters()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local channel layer broker for MoveLine.")
+    parser.add_argument("--unix", help="Unix domain socket path to listen on.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    target = args.unix or f"{args.host}:{args.port}"
+    print(f"MoveLine channel broker listening on {target}")
+    try:
+        asyncio.run(serve(unix_path=args.unix, host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
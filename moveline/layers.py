@@ -0,0 +1,374 @@
+"""
+Channel layer that speaks a small subset of the Redis protocol.
+
+It runs against a real Redis server (``redis://host:port/db``) or against the
+local broker in ``moveline.broker`` over a Unix domain socket
+(``unix:///path/to/socket``), which lets several ASGI worker processes on one
+host share channels and groups.
+"""
+
+import asyncio
+import time
+import uuid
+from collections import deque
+from urllib.parse import urlparse
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .resp import RespError, encode_command, read_reply
+
+RECEIVE_POLL_SEC = 5
+RECONNECT_DELAY_SEC = 1
+# First element of a primed recent list, so an empty one still exists.
+RECENT_PRIMED = b""
+
+
+class RespConnection:
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._lock = asyncio.Lock()
+        self.broken = False
+
+    @classmethod
+    async def open(cls, url):
+        parsed = urlparse(url)
+        if parsed.scheme == "unix":
+            reader, writer = await asyncio.open_unix_connection(parsed.path)
+        elif parsed.scheme in ("redis", "tcp"):
+            reader, writer = await asyncio.open_connection(parsed.hostname or "127.0.0.1", parsed.port or 6379)
+        else:
+            raise ValueError(f"Unsupported channel layer URL: {url}")
+        connection = cls(reader, writer)
+        db = parsed.path.strip("/") if parsed.scheme == "redis" else ""
+        if db and db != "0":
+            await connection.execute("SELECT", db)
+        return connection
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands):
+        if not commands:
+            return []
+        async with self._lock:
+            try:
+                self._writer.write(b"".join(encode_command(command) for command in commands))
+                await self._writer.drain()
+                replies = [await read_reply(self._reader) for _ in commands]
+            except BaseException:
+                # A failed or cancelled exchange leaves unread replies behind.
+                self.broken = True
+                raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+
+
+class LocalInbox:
+    """
+    Single-reader inbox for a process-specific channel. An idle connection
+    holds one of these, so it is a slotted object with a lazily created deque
+    instead of an ``asyncio.Queue`` (which carries three deques and an
+    ``Event`` each).
+    """
+
+    __slots__ = ("messages", "waiter")
+
+    def __init__(self):
+        self.messages = None
+        self.waiter = None
+
+    def put(self, message):
+        if self.messages is None:
+            self.messages = deque()
+        self.messages.append(message)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self):
+        # The message stays queued until the reader actually resumes, so a
+        # cancelled read never loses it.
+        while not self.messages:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.messages.popleft()
+
+    def __len__(self):
+        return len(self.messages) if self.messages else 0
+
+
+class RespChannelLayer(BaseChannelLayer):
+    """
+    Messages are msgpack-encoded and stored in lists; groups are sorted sets
+    scored by join time so stale members expire after ``group_expiry``.
+    Process-specific channels (``specific.<client>!<id>``) share one list per
+    layer instance, drained by a single reader task and routed locally.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        url="unix:///tmp/moveline-channels.sock",
+        prefix="asgi",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.url = url
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.client_prefix = uuid.uuid4().hex
+        self._connections = {}
+        self._local_queues = {}
+        self._reader_task = None
+
+    # ---------------------------------------------------------
+    # Helpers
+    # ---------------------------------------------------------
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
+
+    def _group_key(self, group):
+        return f"{self.prefix}:group:{group}"
+
+    def _list_key(self, channel):
+        if "!" in channel:
+            return self._key(self.non_local_name(channel))
+        return self._key(channel)
+
+    def serialize(self, channel, message):
+        # The channel name travels in front of the payload so one packed
+        # message can be reused for every member of a group.
+        return channel.encode("ascii") + b"\n" + message
+
+    def deserialize(self, data):
+        channel, _, body = data.partition(b"\n")
+        return channel.decode("ascii"), msgpack.unpackb(body, raw=False)
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None or connection.broken:
+            if connection is not None:
+                await connection.close()
+            for stale in [stale for stale in self._connections if stale.is_closed()]:
+                del self._connections[stale]
+            connection = self._connections[loop] = await RespConnection.open(self.url)
+        return connection
+
+    # ---------------------------------------------------------
+    # Channel layer API
+    # ---------------------------------------------------------
+    async def new_channel(self, prefix="specific"):
+        # Every process-specific channel shares this instance's inbox list,
+        # so the caller's prefix goes after the "!".
+        return f"specific.{self.client_prefix}!{prefix}.{uuid.uuid4().hex}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        key = self._list_key(channel)
+        connection = await self._connection()
+        if await connection.execute("LLEN", key) >= self.get_capacity(channel):
+            raise ChannelFull()
+        await connection.pipeline(
+            [
+                ("RPUSH", key, self.serialize(channel, msgpack.packb(message, use_bin_type=True))),
+                ("EXPIRE", key, self.expiry),
+            ]
+        )
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if "!" not in channel:
+            return await self._receive_shared(channel)
+
+        assert self.non_local_name(channel).endswith(self.client_prefix + "!"), "Channel belongs to another layer"
+        queue = self._local_queues.get(channel)
+        if queue is None:
+            queue = self._local_queues[channel] = LocalInbox()
+        if self._reader_task is None or self._reader_task.done():
+            self._reader_task = asyncio.ensure_future(self._read_specific())
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            self._local_queues.pop(channel, None)
+            raise
+
+    async def _receive_shared(self, channel):
+        connection = await RespConnection.open(self.url)
+        try:
+            while True:
+                reply = await connection.execute("BLPOP", self._key(channel), RECEIVE_POLL_SEC)
+                if reply:
+                    return self.deserialize(reply[1])[1]
+        finally:
+            await connection.close()
+
+    async def _read_specific(self):
+        key = self._key(f"specific.{self.client_prefix}!")
+        while self._local_queues:
+            try:
+                connection = await RespConnection.open(self.url)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY_SEC)
+                continue
+            try:
+                while self._local_queues:
+                    reply = await connection.execute("BLPOP", key, RECEIVE_POLL_SEC)
+                    if not reply:
+                        continue
+                    channel, message = self.deserialize(reply[1])
+                    queue = self._local_queues.get(channel)
+                    if queue is not None:
+                        queue.put(message)
+            except (OSError, asyncio.IncompleteReadError):
+                await asyncio.sleep(RECONNECT_DELAY_SEC)
+            finally:
+                await connection.close()
+
+    async def flush(self):
+        connection = await self._connection()
+        keys = await connection.execute("KEYS", f"{self.prefix}:*")
+        if keys:
+            await connection.execute("DEL", *keys)
+        self._local_queues.clear()
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        for connection in self._connections.values():
+            await connection.close()
+        self._connections.clear()
+
+    # ---------------------------------------------------------
+    # Groups extension
+    # ---------------------------------------------------------
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        key = self._group_key(group)
+        connection = await self._connection()
+        await connection.pipeline([("ZADD", key, time.time(), channel), ("EXPIRE", key, self.group_expiry)])
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        await connection.execute("ZREM", self._group_key(group), channel)
+
+    async def group_size(self, group):
+        self.require_valid_group_name(group)
+        key = self._group_key(group)
+        connection = await self._connection()
+        _, size = await connection.pipeline(
+            [
+                ("ZREMRANGEBYSCORE", key, 0, time.time() - self.group_expiry),
+                ("ZCARD", key),
+            ]
+        )
+        return size
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        key = self._group_key(group)
+        connection = await self._connection()
+        _, members = await connection.pipeline(
+            [
+                ("ZREMRANGEBYSCORE", key, 0, time.time() - self.group_expiry),
+                ("ZRANGE", key, 0, -1),
+            ]
+        )
+        if not members:
+            return
+
+        channels = [member.decode("ascii") for member in members]
+        list_keys = [self._list_key(channel) for channel in channels]
+        lengths = await connection.pipeline([("LLEN", list_key) for list_key in list_keys])
+        body = msgpack.packb(message, use_bin_type=True)
+        commands = []
+        for channel, list_key, length in zip(channels, list_keys, lengths):
+            # Full channels drop the message, matching channels_redis.
+            if length >= self.get_capacity(channel):
+                continue
+            commands.append(("RPUSH", list_key, self.serialize(channel, body)))
+            commands.append(("EXPIRE", list_key, self.expiry))
+        await connection.pipeline(commands)
+
+    # ---------------------------------------------------------
+    # Recent lists (see moveline.replay.RecentList)
+    # ---------------------------------------------------------
+    async def recent_range(self, name):
+        connection = await self._connection()
+        items = await connection.execute("LRANGE", self._key(f"recent:{name}"), 0, -1)
+        if not items:
+            return None
+        return [msgpack.unpackb(item, raw=False) for item in items if item != RECENT_PRIMED]
+
+    async def recent_prime(self, name, values, ttl):
+        key = self._key(f"recent:{name}")
+        connection = await self._connection()
+        await connection.pipeline(
+            [
+                ("DEL", key),
+                ("RPUSH", key, RECENT_PRIMED, *(msgpack.packb(value, use_bin_type=True) for value in values)),
+                ("EXPIRE", key, ttl),
+            ]
+        )
+
+    async def recent_push(self, name, value, size, ttl):
+        key = self._key(f"recent:{name}")
+        connection = await self._connection()
+        # RPUSHX leaves a list that is not primed alone.
+        await connection.pipeline(
+            [
+                ("RPUSHX", key, msgpack.packb(value, use_bin_type=True)),
+                ("LTRIM", key, -size, -1),
+                ("EXPIRE", key, ttl),
+            ]
+        )
+
+
+async def group_size(layer, group):
+    """
+    Number of channels in ``group``, or ``None`` when the layer cannot tell.
+    """
+    if hasattr(layer, "group_size"):
+        return await layer.group_size(group)
+    groups = getattr(layer, "groups", None)
+    if isinstance(groups, dict):
+        return len(groups.get(group, ()))
+    return None
+
+
+def local_queue_sizes(layer):
+    """
+    Pending message counts of this process's channel inboxes, or ``None``
+    when the layer does not expose them.
+    """
+    queues = getattr(layer, "_local_queues", None)
+    if queues is not None:
+        return [len(queue) for queue in list(queues.values())]
+    queues = getattr(layer, "channels", None)
+    if isinstance(queues, dict):
+        return [queue.qsize() for queue in list(queues.values())]
+    return None
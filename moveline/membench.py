@@ -0,0 +1,172 @@
+"""
+Memory cost of idle websocket connections.
+
+Opens ``--connections`` idle tracking subscribers (or chat members) against
+the ASGI websocket app in-process, using the in-memory channel layer, and
+prints a JSON report with the traced bytes per connection and the top
+allocation sites. ``--layer resp`` uses ``RespChannelLayer`` against a
+broker started in a subprocess, so only the ASGI process is measured. Every
+socket is authenticated as an unsaved staff user, tracking runs resume from a
+primed replay buffer and chat runs replay a primed recent list, so no
+database is needed.
+
+    python -m moveline.membench --consumer tracking --connections 10000 --orders 100
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+async def open_connection(app, path, query_string=b"", harness=None):
+    # The harness objects stand in for the protocol server; they can be
+    # created up front so they are not counted against the app.
+    inbox, accepted = harness or (asyncio.Queue(), asyncio.Event())
+
+    closed = []
+
+    async def send(message):
+        if message["type"] == "websocket.close":
+            closed.append(message.get("code"))
+        if message["type"] in ("websocket.accept", "websocket.close"):
+            accepted.set()
+
+    scope = {
+        "type": "websocket",
+        "path": path,
+        "query_string": query_string,
+        "headers": [],
+        "subprotocols": [],
+    }
+    task = asyncio.create_task(app(scope, inbox.get, send))
+    await inbox.put({"type": "websocket.connect"})
+    await accepted.wait()
+    if closed:
+        # A rejected socket would measure nothing but the rejection.
+        raise SystemExit(f"{path} was rejected with code {closed[0]}")
+    return task, inbox
+
+
+async def close_connection(task, inbox):
+    await inbox.put({"type": "websocket.disconnect", "code": 1000})
+    try:
+        await asyncio.wait_for(task, timeout=5)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        task.cancel()
+
+
+def _traced():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def run(args):
+    from channels.layers import get_channel_layer
+    from channels.routing import URLRouter
+    from django.contrib.auth import get_user_model
+
+    from chat.consumers import ChatConsumer, recent_messages
+    from moveline.routing import websocket_urlpatterns
+    from tracking.consumers import TrackingConsumer, replay_buffer
+    from users.middleware import JWTAuthMiddleware
+
+    class BenchAuthMiddleware(JWTAuthMiddleware):
+        # Chat only accepts participants; staff pass without a query.
+        user = get_user_model()(username="membench", is_staff=True)
+
+        async def _get_user(self, raw_token):
+            return self.user
+
+    app = BenchAuthMiddleware(URLRouter(websocket_urlpatterns))
+    orders = range(1, args.orders + 1)
+    for order in orders:
+        if args.consumer == "tracking":
+            replay_buffer.append(str(order), 0, {"order": order, "sequence": 0})
+        else:
+            await recent_messages.prime(get_channel_layer(), str(order), [])
+
+    def target(index):
+        order = orders[index % len(orders)]
+        if args.consumer == "tracking":
+            return f"/ws/tracking/{order}/", b"role=subscriber&last_seq=0"
+        return f"/ws/chat/{order}/", b""
+
+    # Warm up imports, caches and the channel layer before measuring.
+    await close_connection(*await open_connection(app, *target(0)))
+    consumer_class = TrackingConsumer if args.consumer == "tracking" else ChatConsumer
+    gc.collect()
+    earlier = {id(obj) for obj in gc.get_objects() if isinstance(obj, consumer_class)}
+
+    harnesses = [(asyncio.Queue(), asyncio.Event()) for _ in range(args.connections)]
+    tracemalloc.start(args.frames)
+    before = _traced()
+    baseline = tracemalloc.take_snapshot()
+    connections = [
+        await open_connection(app, *target(index), harness=harnesses[index]) for index in range(args.connections)
+    ]
+    await asyncio.sleep(0)
+    after = _traced()
+    top = tracemalloc.take_snapshot().compare_to(baseline, "filename")[: args.top]
+    tracemalloc.stop()
+    # Only the measured (accepted, still open) consumers.
+    consumers = [obj for obj in gc.get_objects() if isinstance(obj, consumer_class) and id(obj) not in earlier]
+    instance_bytes = [sys.getsizeof(consumer) + sys.getsizeof(consumer.__dict__) for consumer in consumers]
+
+    await asyncio.gather(*(close_connection(task, inbox) for task, inbox in connections))
+    total = after - before
+    return {
+        "consumer": args.consumer,
+        "layer": args.layer,
+        "connections": args.connections,
+        "orders": args.orders,
+        "bytes_total": total,
+        "bytes_per_connection": round(total / args.connections, 1),
+        "consumer_instance_bytes": round(sum(instance_bytes) / len(instance_bytes), 1) if instance_bytes else None,
+        "consumer_attributes": sorted(vars(consumers[-1])) if consumers else [],
+        "top_allocations": [
+            {"file": str(stat.traceback[0].filename), "bytes_per_connection": round(stat.size_diff / args.connections, 1)}
+            for stat in top
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per idle websocket connection.")
+    parser.add_argument("--consumer", choices=("tracking", "chat"), default="tracking")
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=100, help="Connections are spread over this many orders.")
+    parser.add_argument("--top", type=int, default=8, help="Allocation sites to list.")
+    parser.add_argument("--frames", type=int, default=1)
+    parser.add_argument("--layer", choices=("memory", "resp"), default="memory")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "moveline.settings")
+    os.environ.pop("CHANNEL_LAYER_URL", None)
+    broker = None
+    if args.layer == "resp":
+        socket_path = os.path.join(tempfile.mkdtemp(), "membench.sock")
+        broker = subprocess.Popen([sys.executable, "-m", "moveline.broker", "--unix", socket_path])
+        while not os.path.exists(socket_path) and broker.poll() is None:
+            time.sleep(0.05)
+        os.environ["CHANNEL_LAYER_URL"] = f"unix://{socket_path}"
+
+    import django
+
+    django.setup()
+    try:
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+    finally:
+        if broker is not None:
+            broker.terminate()
+            broker.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Process-local counters for the realtime stack, exposed by ``MetricsView``.
+
+With ``METRICS_ENABLED`` the consumers also record per-phase handler latency
+histograms and a sampler task reports event-loop lag, ``sync_to_async``
+executor backlog and channel-layer inbox sizes. When it is off ``timer()``
+returns a shared no-op and nothing is sampled.
+"""
+
+import asyncio
+import functools
+import math
+import time
+import weakref
+from bisect import bisect_left
+from collections import Counter
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+from django.db import connection
+
+LATENCY_BUCKETS_MS = (0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LOOP_SAMPLE_INTERVAL_SEC = 0.25
+
+_counters = Counter()
+_histograms = {}
+_gauges = {}
+_monitors = weakref.WeakKeyDictionary()
+_enabled = getattr(settings, "METRICS_ENABLED", False)
+
+
+def increment(name, value=1):
+    _counters[name] += value
+
+
+def counts_queries(name):
+    """
+    Count the SQL queries a synchronous function runs under ``name``. Stack
+    it below ``sync_to_async`` so the wrapper runs on the DB thread.
+    """
+
+    def decorator(func):
+        def count(execute, sql, params, many, context):
+            _counters[name] += 1
+            return execute(sql, params, many, context)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with connection.execute_wrapper(count):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram:
+    """Fixed-bucket latency histogram in milliseconds."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given rank."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        buckets = {str(bound): count for bound, count in zip(LATENCY_BUCKETS_MS, self.counts) if count}
+        if self.counts[-1]:
+            buckets["+Inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "max": round(self.max, 3),
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "buckets": buckets,
+        }
+
+
+def observe(name, value):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram()
+    histogram.observe(value)
+
+
+class _Timer:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """``with metrics.timer("tracking.receive.db"): ...`` records milliseconds."""
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled):
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def ensure_loop_monitor(channel_layer=None):
+    """Start the sampler for the running event loop once, if enabled."""
+    if not _enabled:
+        return
+    loop = asyncio.get_running_loop()
+    task = _monitors.get(loop)
+    if task is None or task.done():
+        _monitors[loop] = loop.create_task(_monitor_loop(channel_layer))
+
+
+async def _monitor_loop(channel_layer):
+    from .layers import local_queue_sizes
+
+    loop = asyncio.get_running_loop()
+    while _enabled:
+        started = loop.time()
+        await asyncio.sleep(LOOP_SAMPLE_INTERVAL_SEC)
+        # Anything beyond the requested sleep is time the loop spent busy.
+        lag_ms = max(0.0, (loop.time() - started - LOOP_SAMPLE_INTERVAL_SEC) * 1000)
+        observe("loop.lag_ms", lag_ms)
+        _gauges["loop.lag_ms"] = round(lag_ms, 3)
+        _gauges["executor.default.queued"] = _executor_backlog(getattr(loop, "_default_executor", None))
+        _gauges["executor.thread_sensitive.queued"] = _executor_backlog(SyncToAsync.single_thread_executor) + sum(
+            _executor_backlog(executor) for executor in list(SyncToAsync.context_to_thread_executor.values())
+        )
+        sizes = local_queue_sizes(channel_layer) if channel_layer is not None else None
+        if sizes is not None:
+            _gauges["layer.channels"] = len(sizes)
+            _gauges["layer.queued"] = sum(sizes)
+            _gauges["layer.queued.max"] = max(sizes, default=0)
+
+
+def _executor_backlog(executor):
+    work_queue = getattr(executor, "_work_queue", None)
+    return work_queue.qsize() if work_queue is not None else 0
+
+
+def snapshot() -> dict:
+    return {
+        "enabled": _enabled,
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "histograms": {name: histogram.snapshot() for name, histogram in list(_histograms.items())},
+    }
+
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
+    _gauges.clear()
@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import json
+import logging
+from urllib.parse import urlencode
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from chat.consumers import ChatConsumer
+from tracking.consumers import TrackingConsumer
+
+from .layers import LocalInbox
+
+STREAM_APPS = {
+    "tracking": TrackingConsumer.as_asgi(),
+    "chat": ChatConsumer.as_asgi(),
+}
+STREAM_QUERY_PARAMS = ("role", "last_seq")
+MAX_STREAMS = 50
+STREAM_CLOSE_TIMEOUT_SEC = 5
+STREAM_CRASHED_CODE = 1011
+
+logger = logging.getLogger(__name__)
+
+
+class MultiplexConsumer(AsyncWebsocketConsumer):
+    """
+    One socket carrying tracking and chat streams for many orders.
+
+    ``{"action": "subscribe", "stream": "tracking", "order": 104}`` (optionally
+    with ``role`` and ``last_seq``) runs the same consumer that serves
+    ``ws/tracking/104/`` inside this connection; ``{"action": "unsubscribe",
+    ...}`` stops it. Frames in both directions are wrapped as
+    ``{"stream": "tracking:104", "payload": {...}}``. Stream lifecycle is
+    reported as ``{"stream": ..., "event": "subscribed" | "closed"}``.
+    """
+
+    async def connect(self):
+        self.streams = {}
+        self.reports = set()
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for name in list(self.streams):
+            await self._stop_stream(name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            message = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        action = message.get("action")
+        if action is None:
+            inbox = self.streams.get(message.get("stream"), (None, None))[1]
+            if inbox is not None and "payload" in message:
+                inbox.put({"type": "websocket.receive", "text": json.dumps(message["payload"])})
+            return
+
+        try:
+            kind = message["stream"]
+            order = int(message["order"])
+        except (KeyError, TypeError, ValueError):
+            await self._send_error(None, "Invalid stream.")
+            return
+        if kind not in STREAM_APPS:
+            await self._send_error(None, "Unknown stream.")
+            return
+        name = f"{kind}:{order}"
+        if action == "subscribe":
+            await self._start_stream(name, kind, order, message)
+        elif action == "unsubscribe":
+            await self._stop_stream(name)
+
+    async def _start_stream(self, name, kind, order, message):
+        if name in self.streams:
+            return
+        if len(self.streams) >= MAX_STREAMS:
+            await self._send_error(name, "Too many streams.")
+            return
+
+        query = {key: message[key] for key in STREAM_QUERY_PARAMS if message.get(key) is not None}
+        scope = dict(
+            self.scope,
+            path=f"/ws/{kind}/{order}/",
+            query_string=urlencode(query).encode("latin-1"),
+            subprotocols=[],
+            url_route={"args": (), "kwargs": {"order_id": str(order)}},
+        )
+        inbox = LocalInbox()
+        task = asyncio.create_task(STREAM_APPS[kind](scope, inbox.get, self._stream_sender(name)))
+        self.streams[name] = (task, inbox)
+        task.add_done_callback(functools.partial(self._stream_done, name))
+        inbox.put({"type": "websocket.connect"})
+
+    def _stream_done(self, name, task):
+        # Streams that closed or were stopped are already gone; one still
+        # registered here ended on its own, usually by raising.
+        stream = self.streams.get(name)
+        if stream is None or stream[0] is not task:
+            return
+        del self.streams[name]
+        code = 1000
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Stream %s crashed", name, exc_info=task.exception())
+            code = STREAM_CRASHED_CODE
+        report = asyncio.ensure_future(
+            self.send(text_data=json.dumps({"stream": name, "event": "closed", "code": code}))
+        )
+        self.reports.add(report)
+        report.add_done_callback(self.reports.discard)
+
+    async def _stop_stream(self, name, code=1000):
+        stream = self.streams.pop(name, None)
+        if stream is None:
+            return
+        task, inbox = stream
+        inbox.put({"type": "websocket.disconnect", "code": code})
+        try:
+            await asyncio.wait_for(task, STREAM_CLOSE_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            pass
+        except Exception:
+            # The inner consumer already crashed; its stream is gone either way.
+            pass
+
+    def _stream_sender(self, name):
+        prefix = f'{{"stream":{json.dumps(name)},'
+
+        async def send(message):
+            kind = message["type"]
+            if kind == "websocket.send":
+                if message.get("text") is not None:
+                    await self.send(text_data=f'{prefix}"payload":{message["text"]}}}')
+            elif kind == "websocket.accept":
+                await self.send(text_data=f'{prefix}"event":"subscribed"}}')
+            elif kind == "websocket.close":
+                code = message.get("code") or 1000
+                await self.send(text_data=f'{prefix}"event":"closed","code":{int(code)}}}')
+                # Let the inner consumer run its disconnect handler and stop.
+                stream = self.streams.pop(name, None)
+                if stream is not None:
+                    stream[1].put({"type": "websocket.disconnect", "code": code})
+
+        return send
+
+    async def _send_error(self, name, detail):
+        await self.send(text_data=json.dumps({"stream": name, "event": "error", "detail": detail}))
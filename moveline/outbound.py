@@ -0,0 +1,118 @@
+import asyncio
+import functools
+import time
+from collections import deque
+
+from . import metrics
+
+CLOSE_CODE_TOO_SLOW = 4008
+OUTBOUND_BUFFER_POLL_SEC = 0.1
+
+
+def write_buffer_size(send):
+    """
+    Bytes the protocol server has accepted from ``send`` but not yet written
+    to the client's socket, or ``None`` when it cannot tell. Daphne passes
+    ``partial(server.handle_reply, protocol)``; the protocol's transport is
+    an asyncio or Twisted transport.
+    """
+    if not isinstance(send, functools.partial) or not send.args:
+        return None
+    transport = getattr(send.args[0], "transport", None)
+    if transport is None:
+        return None
+    if hasattr(transport, "get_write_buffer_size"):
+        return transport.get_write_buffer_size()
+    if hasattr(transport, "dataBuffer"):
+        return len(transport.dataBuffer) - transport.offset + getattr(transport, "_tempDataLen", 0)
+    return None
+
+
+class OutboundQueueMixin:
+    """
+    Bounded per-connection outbound queue for websocket consumers.
+
+    Channel-layer handlers call ``queue_send`` instead of ``send`` so they
+    return immediately and the connection's channel keeps draining even when
+    the client reads slowly. A writer task is only alive while there is
+    something to send. When the queue is full the oldest frame is dropped
+    (``outbound_drop_oldest``) or the client is disconnected; a client whose
+    oldest pending frame is older than ``outbound_max_lag_sec`` is
+    disconnected either way.
+
+    Daphne's ``send`` never waits for the client: it appends to the
+    transport's write buffer. Frames are therefore held in this queue while
+    that buffer is above ``outbound_max_buffer_bytes``, so the bounds above
+    also hold under Daphne. The lag is then re-checked every
+    ``OUTBOUND_BUFFER_POLL_SEC`` even when nothing new is queued.
+
+    Stateful encoders (e.g. delta codecs) pass ``encode``, a callable
+    returning the ``send`` keyword arguments. It runs only when the frame is
+    actually sent, so dropped frames never advance the encoder's state.
+    """
+
+    outbound_limit = 64
+    outbound_drop_oldest = True
+    outbound_max_lag_sec = 15.0
+    outbound_max_buffer_bytes = 256 * 1024
+    outbound_metrics_prefix = "ws"
+
+    _outbound = None
+    _outbound_writer = None
+    _outbound_evicted = False
+
+    async def queue_send(self, text_data=None, bytes_data=None, encode=None):
+        if self._outbound_evicted:
+            return
+        if self._outbound is None:
+            self._outbound = deque()
+        queue = self._outbound
+        now = time.monotonic()
+
+        if queue and now - queue[0][0] > self.outbound_max_lag_sec:
+            await self._evict_slow_consumer("lagging")
+            return
+        if len(queue) >= self.outbound_limit:
+            if not self.outbound_drop_oldest:
+                await self._evict_slow_consumer("overflow")
+                return
+            queue.popleft()
+            metrics.increment(f"{self.outbound_metrics_prefix}.outbound.dropped")
+
+        queue.append((now, text_data, bytes_data, encode))
+        if self._outbound_writer is None:
+            self._outbound_writer = asyncio.create_task(self._drain_outbound())
+
+    async def _drain_outbound(self):
+        queue = self._outbound
+        try:
+            while queue:
+                buffered = write_buffer_size(getattr(self, "base_send", None))
+                if buffered is not None and buffered > self.outbound_max_buffer_bytes:
+                    if time.monotonic() - queue[0][0] > self.outbound_max_lag_sec:
+                        await self._evict_slow_consumer("lagging")
+                        return
+                    await asyncio.sleep(OUTBOUND_BUFFER_POLL_SEC)
+                    continue
+                _, text_data, bytes_data, encode = queue.popleft()
+                if encode is not None:
+                    await self.send(**encode())
+                else:
+                    await self.send(text_data=text_data, bytes_data=bytes_data)
+                metrics.increment(f"{self.outbound_metrics_prefix}.outbound.sent")
+        finally:
+            self._outbound_writer = None
+
+    async def _evict_slow_consumer(self, reason):
+        self._outbound_evicted = True
+        metrics.increment(f"{self.outbound_metrics_prefix}.outbound.evicted.{reason}")
+        if self._outbound:
+            metrics.increment(f"{self.outbound_metrics_prefix}.outbound.dropped", len(self._outbound))
+            self._outbound.clear()
+        await self.close(code=CLOSE_CODE_TOO_SLOW)
+
+    async def websocket_disconnect(self, message):
+        if self._outbound_writer is not None:
+            self._outbound_writer.cancel()
+        self._outbound = None
+        await super().websocket_disconnect(message)
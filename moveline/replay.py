@@ -0,0 +1,130 @@
+import itertools
+import time
+from collections import OrderedDict, deque
+
+
+class ReplayBuffer:
+    """
+    Process-local ring buffers of recent ``(sequence, payload)`` entries per
+    key, so a reconnecting client can be sent what it missed without touching
+    the database. At most ``max_keys`` keys are kept (least recently written
+    first out) and keys idle for ``ttl_sec`` are dropped.
+
+    Every consumer that receives a broadcast appends it; entries whose
+    sequence is not newer than the last one are ignored, so many consumers in
+    one process feeding the same key is cheap.
+    """
+
+    def __init__(self, size=64, max_keys=10000, ttl_sec=600):
+        self.size = size
+        self.max_keys = max_keys
+        self.ttl_sec = ttl_sec
+        self._buffers = OrderedDict()
+
+    def _create(self, key, entries=()):
+        entry = self._buffers[key] = [time.monotonic(), deque(entries, maxlen=self.size)]
+        while len(self._buffers) > self.max_keys:
+            self._buffers.popitem(last=False)
+        return entry
+
+    def _live(self, key):
+        entry = self._buffers.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl_sec:
+            del self._buffers[key]
+            return None
+        return entry
+
+    def append(self, key, sequence, payload):
+        now = time.monotonic()
+        entry = self._buffers.get(key)
+        if entry is None:
+            entry = self._create(key)
+        else:
+            self._buffers.move_to_end(key)
+        entries = entry[1]
+        if entries and sequence <= entries[-1][0]:
+            return
+        entry[0] = now
+        entries.append((sequence, payload))
+
+    def since(self, key, sequence):
+        """
+        Payloads newer than ``sequence``, or ``None`` when the buffer cannot
+        bridge the gap and the caller has to fall back to a full snapshot.
+        Sequences are consecutive integers, so a missing one (an update this
+        process never saw) is a gap too.
+        """
+        entry = self._live(key)
+        if entry is None:
+            return None
+        entries = entry[1]
+        if not entries or sequence < entries[0][0] - 1 or sequence > entries[-1][0]:
+            return None
+        missed = []
+        for entry_sequence, payload in entries:
+            if entry_sequence <= sequence:
+                continue
+            if entry_sequence != sequence + len(missed) + 1:
+                return None
+            missed.append(payload)
+        return missed
+
+    def prime(self, key, entries):
+        """Seed ``key`` with ``(sequence, payload)`` pairs unless it is already buffered."""
+        if self._live(key) is None:
+            self._create(key, entries)
+
+    def recent(self, key):
+        """Every buffered payload for ``key``, or ``None`` when it is not buffered."""
+        entry = self._live(key)
+        return None if entry is None else [payload for _, payload in entry[1]]
+
+    def discard(self, key):
+        self._buffers.pop(key, None)
+
+    def __len__(self):
+        return len(self._buffers)
+
+
+class RecentList:
+    """
+    The last ``size`` values per key, e.g. chat messages replayed on
+    connect. With a layer that stores lists (``RespChannelLayer``) they live
+    in the broker, so every worker process serves the same list; otherwise
+    (the in-memory layer, one process) in a local ``ReplayBuffer``.
+
+    ``get`` returns ``None`` for a key that is not primed. ``push`` only
+    stores into a primed key, so a list that expired or was evicted is never
+    recreated holding just its newest values.
+    """
+
+    def __init__(self, name, size, ttl_sec=600):
+        self.name = name
+        self.size = size
+        self.ttl_sec = ttl_sec
+        self.local = ReplayBuffer(size=size, ttl_sec=ttl_sec)
+        self._sequence = itertools.count()
+
+    def _shared_name(self, key):
+        return f"{self.name}:{key}"
+
+    async def get(self, layer, key):
+        if hasattr(layer, "recent_range"):
+            return await layer.recent_range(self._shared_name(key))
+        return self.local.recent(key)
+
+    async def prime(self, layer, key, values):
+        if hasattr(layer, "recent_prime"):
+            await layer.recent_prime(self._shared_name(key), values[-self.size :], self.ttl_sec)
+            return
+        self.local.discard(key)
+        self.local.prime(key, [(next(self._sequence), value) for value in values])
+
+    async def push(self, layer, key, value):
+        if hasattr(layer, "recent_push"):
+            await layer.recent_push(self._shared_name(key), value, self.size, self.ttl_sec)
+        elif self.local.recent(key) is not None:
+            self.local.append(key, next(self._sequence), value)
+
+    def discard(self, key):
+        self.local.discard(key)
@@ -0,0 +1,78 @@
+"""
+Minimal RESP (Redis serialization protocol) framing shared by the channel
+layer client in ``moveline.layers`` and the local broker in ``moveline.broker``.
+"""
+
+CRLF = b"\r\n"
+
+
+class RespError(Exception):
+    pass
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value).encode("ascii")
+    return str(value).encode("ascii")
+
+
+def encode_command(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = _to_bytes(arg)
+        parts.append(b"$%d\r\n" % len(data))
+        parts.append(data)
+        parts.append(CRLF)
+    return b"".join(parts)
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-" + _to_bytes(str(value)) + CRLF
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+" + _to_bytes(value) + CRLF
+    if isinstance(value, (bytes, float)):
+        data = _to_bytes(value)
+        return b"$%d\r\n" % len(data) + data + CRLF
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+    raise TypeError(f"Cannot encode {type(value).__name__} as RESP")
+
+
+async def read_reply(reader):
+    """
+    Read one RESP value. Error replies are returned (not raised) as
+    ``RespError`` instances so pipelined callers can drain every reply first.
+    """
+    line = await reader.readline()
+    if not line.endswith(CRLF):
+        raise ConnectionResetError("RESP connection closed")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode("utf-8")
+    if prefix == b"-":
+        return RespError(rest.decode("utf-8"))
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unknown RESP type {prefix!r}")
@@ -1,6 +1,14 @@
+from django.urls import re_path
+
 from chat.routing import websocket_urlpatterns as chat_websocket_urlpatterns
 from tracking.routing import websocket_urlpatterns as tracking_websocket_urlpatterns
 
-websocket_urlpatterns = tracking_websocket_urlpatterns + chat_websocket_urlpatterns
+from .multiplex import MultiplexConsumer
+
+websocket_urlpatterns = (
+    [re_path(r"ws/stream/$", MultiplexConsumer.as_asgi())]
+    + tracking_websocket_urlpatterns
+    + chat_websocket_urlpatterns
+)
 
 __all__ = ["websocket_urlpatterns"]
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'vehicles',
     'payments',
     'tracking',
+    'chat',
     'ai_analyze',
     'ratings',
     # 'notifications',  # optional
@@ -233,8 +234,35 @@ AUTH_USER_MODEL = 'users.User'
 # -------------------------------------------------------------
 # CHANNELS
 # -------------------------------------------------------------
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+# Set CHANNEL_LAYER_URL to share groups between several ASGI worker processes,
+# e.g. unix:///tmp/moveline-channels.sock (served by `python -m moveline.broker`)
+# or redis://127.0.0.1:6379/0.
+CHANNEL_LAYER_URL = os.getenv("CHANNEL_LAYER_URL")
+# Handler latency histograms and event-loop sampling for /api/metrics/.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED") == "1"
+
+if CHANNEL_LAYER_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "moveline.layers.RespChannelLayer",
+            "CONFIG": {
+                "url": CHANNEL_LAYER_URL,
+            },
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        }
+    }
+
+# -------------------------------------------------------------
+# AI ANALYZE
+# -------------------------------------------------------------
+# Load and warm the YOLO model when the app starts rather than on the first
+# analyze request; /api/ai/ready/ answers 503 until the model is hot.
+AI_EAGER_WARMUP = os.getenv("AI_EAGER_WARMUP") == "1"
+# Run inference on `python -m ai_analyze.inference` instead of in the web
+# worker, e.g. /tmp/moveline-inference.sock.
+AI_INFERENCE_SOCKET = os.getenv("AI_INFERENCE_SOCKET")
@@ -0,0 +1,388 @@
+import asyncio
+import functools
+import os
+import tempfile
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from channels.exceptions import ChannelFull
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase, TestCase
+
+from orders.models import Order
+from tracking.models import Tracking
+
+from . import metrics
+from .broker import Broker, start_server
+from .layers import LocalInbox, RespChannelLayer, group_size
+from .multiplex import STREAM_APPS
+from .outbound import CLOSE_CODE_TOO_SLOW, OutboundQueueMixin
+from .replay import RecentList, ReplayBuffer
+from .routing import websocket_urlpatterns
+
+
+class RespChannelLayerTest(SimpleTestCase):
+    async def _run(self, check):
+        path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+        broker = Broker()
+        server = await start_server(broker, unix_path=path)
+        # Two layer instances stand in for two worker processes.
+        first = RespChannelLayer(url=f"unix://{path}", capacity=2)
+        second = RespChannelLayer(url=f"unix://{path}", capacity=2)
+        try:
+            await check(first, second)
+        finally:
+            await first.close()
+            await second.close()
+            # Let the broker notice the closed clients before shutting down.
+            await asyncio.sleep(0.05)
+            broker.release_waiters()
+            await asyncio.sleep(0.05)
+            server.close()
+            await server.wait_closed()
+
+    async def test_send_receive_across_layers(self):
+        async def check(first, second):
+            channel = await first.new_channel()
+            await second.send(channel, {"type": "test.message", "value": 1})
+            message = await first.receive(channel)
+            self.assertEqual(message, {"type": "test.message", "value": 1})
+
+        await self._run(check)
+
+    async def test_group_send_reaches_members_in_other_processes(self):
+        async def check(first, second):
+            one = await first.new_channel()
+            two = await second.new_channel()
+            await first.group_add("tracking_1", one)
+            await second.group_add("tracking_1", two)
+            await first.group_send("tracking_1", {"type": "tracking.update", "payload": {"order": 1}})
+            self.assertEqual((await first.receive(one))["payload"], {"order": 1})
+            self.assertEqual((await second.receive(two))["payload"], {"order": 1})
+            self.assertEqual(await group_size(first, "tracking_1"), 2)
+
+            await second.group_discard("tracking_1", two)
+            self.assertEqual(await group_size(first, "tracking_1"), 1)
+            await first.group_send("tracking_1", {"type": "tracking.update", "payload": {"order": 2}})
+            self.assertEqual((await first.receive(one))["payload"], {"order": 2})
+
+        await self._run(check)
+
+    async def test_capacity_and_flush(self):
+        async def check(first, second):
+            await first.send("worker", {"type": "a"})
+            await first.send("worker", {"type": "b"})
+            with self.assertRaises(ChannelFull):
+                await first.send("worker", {"type": "c"})
+            self.assertEqual(await second.receive("worker"), {"type": "a"})
+            await first.flush()
+            await first.send("worker", {"type": "d"})
+            self.assertEqual(await second.receive("worker"), {"type": "d"})
+
+        await self._run(check)
+
+    async def test_recent_lists_are_shared_across_layers(self):
+        async def check(first, second):
+            recent = RecentList("chat", size=2)
+            await recent.push(first, "7", {"m": 0})
+            self.assertIsNone(await recent.get(second, "7"))
+
+            await recent.prime(first, "7", [])
+            self.assertEqual(await recent.get(second, "7"), [])
+            for value, layer in ((1, first), (2, second), (3, first)):
+                await recent.push(layer, "7", {"m": value})
+            self.assertEqual(await recent.get(second, "7"), [{"m": 2}, {"m": 3}])
+            await recent.prime(second, "7", [{"m": 4}])
+            self.assertEqual(await recent.get(first, "7"), [{"m": 4}])
+
+        await self._run(check)
+
+
+class StalledConsumer(OutboundQueueMixin):
+    outbound_limit = 2
+    outbound_metrics_prefix = "test"
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.unblock = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.unblock.wait()
+        self.sent.append(text_data)
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+class BufferingConsumer(OutboundQueueMixin):
+    """Stands in for a consumer under Daphne: ``send`` returns at once."""
+
+    outbound_limit = 2
+    outbound_max_lag_sec = 0.3
+    outbound_max_buffer_bytes = 10
+    outbound_metrics_prefix = "test"
+
+    def __init__(self):
+        self.transport = SimpleNamespace(get_write_buffer_size=lambda: self.buffered)
+        self.base_send = functools.partial(self._handle_reply, SimpleNamespace(transport=self.transport))
+        self.buffered = 0
+        self.sent = []
+        self.closed_with = None
+
+    async def _handle_reply(self, protocol, message):
+        pass
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(text_data)
+        self.buffered += len(text_data)
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+class OutboundQueueTest(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    async def test_drop_oldest_when_full(self):
+        consumer = StalledConsumer()
+        for index in range(4):
+            await consumer.queue_send(text_data=str(index))
+        consumer.unblock.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(consumer.sent, ["2", "3"])
+        self.assertEqual(metrics.snapshot()["counters"]["test.outbound.dropped"], 2)
+
+    async def test_dropped_frames_are_never_encoded(self):
+        consumer = StalledConsumer()
+        encoded = []
+
+        def encoder(index):
+            def encode():
+                encoded.append(index)
+                return {"text_data": str(index)}
+
+            return encode
+
+        for index in range(4):
+            await consumer.queue_send(encode=encoder(index))
+        consumer.unblock.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual((consumer.sent, encoded), (["2", "3"], [2, 3]))
+
+    async def test_full_transport_buffer_holds_frames_in_the_queue(self):
+        consumer = BufferingConsumer()
+        consumer.buffered = 20
+        for index in range(4):
+            await consumer.queue_send(text_data=f"frame-{index}")
+        await asyncio.sleep(0.05)
+        # Nothing goes to the full buffer, and the queue bound still applies.
+        self.assertEqual(consumer.sent, [])
+        self.assertEqual(len(consumer._outbound), 2)
+
+        consumer.buffered = 0
+        await asyncio.sleep(0.15)
+        self.assertEqual(consumer.sent, ["frame-2", "frame-3"])
+
+        # The buffer is full again; a client that never catches up is evicted
+        # without any further frame being queued.
+        await consumer.queue_send(text_data="frame-4")
+        await asyncio.sleep(0.5)
+        self.assertEqual((consumer.sent, consumer.closed_with), (["frame-2", "frame-3"], CLOSE_CODE_TOO_SLOW))
+
+    async def test_overflow_disconnects_when_dropping_is_not_allowed(self):
+        consumer = StalledConsumer()
+        consumer.outbound_drop_oldest = False
+        for index in range(4):
+            await consumer.queue_send(text_data=str(index))
+        self.assertEqual(consumer.closed_with, CLOSE_CODE_TOO_SLOW)
+        self.assertEqual(metrics.snapshot()["counters"]["test.outbound.evicted.overflow"], 1)
+        consumer._outbound_writer.cancel()
+
+
+class LocalInboxTest(SimpleTestCase):
+    async def test_cancelled_reader_does_not_lose_messages(self):
+        inbox = LocalInbox()
+        reader = asyncio.ensure_future(inbox.get())
+        await asyncio.sleep(0)
+        inbox.put({"type": "a"})
+        reader.cancel()
+        inbox.put({"type": "b"})
+        self.assertEqual(await inbox.get(), {"type": "a"})
+        self.assertEqual(await inbox.get(), {"type": "b"})
+        self.assertEqual(len(inbox), 0)
+
+
+class MetricsTest(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.set_enabled, metrics.is_enabled())
+        self.addCleanup(metrics.reset)
+
+    def test_histogram_percentiles(self):
+        histogram = metrics.Histogram()
+        for value in [0.2] * 90 + [30] * 9 + [20000]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(0.5), 0.25)
+        self.assertEqual(histogram.percentile(0.95), 50)
+        self.assertEqual(histogram.percentile(1.0), 20000)
+        self.assertEqual(histogram.snapshot()["buckets"], {"0.25": 90, "50": 9, "+Inf": 1})
+
+    def test_timer_is_a_no_op_when_disabled(self):
+        metrics.set_enabled(False)
+        with metrics.timer("test.phase"):
+            pass
+        self.assertEqual(metrics.snapshot()["histograms"], {})
+
+        metrics.set_enabled(True)
+        with metrics.timer("test.phase"):
+            pass
+        self.assertEqual(metrics.snapshot()["histograms"]["test.phase"]["count"], 1)
+
+    async def test_loop_monitor_reports_lag_and_queues(self):
+        metrics.set_enabled(True)
+        layer = RespChannelLayer()
+        inbox = layer._local_queues["specific.x!a"] = LocalInbox()
+        inbox.put({"type": "a"})
+        metrics.ensure_loop_monitor(layer)
+        await asyncio.sleep(0)
+        # Block the loop well past the sampler's wake-up time.
+        time.sleep(metrics.LOOP_SAMPLE_INTERVAL_SEC + 0.1)
+        await asyncio.sleep(metrics.LOOP_SAMPLE_INTERVAL_SEC)
+        metrics.set_enabled(False)
+
+        snapshot = metrics.snapshot()
+        self.assertGreaterEqual(snapshot["histograms"]["loop.lag_ms"]["max"], 50)
+        self.assertEqual(snapshot["gauges"]["layer.queued"], 1)
+        self.assertEqual(snapshot["gauges"]["executor.thread_sensitive.queued"], 0)
+
+
+class ReplayBufferTest(SimpleTestCase):
+    def test_since_returns_missed_entries_or_none_for_gaps(self):
+        buffer = ReplayBuffer(size=3, max_keys=2)
+        for sequence in range(1, 6):
+            buffer.append("a", sequence, {"seq": sequence})
+        buffer.append("a", 4, {"seq": "late"})
+
+        self.assertEqual(buffer.since("a", 3), [{"seq": 4}, {"seq": 5}])
+        self.assertEqual(buffer.since("a", 5), [])
+        self.assertIsNone(buffer.since("a", 1))
+        self.assertIsNone(buffer.since("a", 9))
+
+        # An update this process never saw breaks the run.
+        for sequence in (12, 13):
+            buffer.append("a", sequence, {"seq": sequence})
+        self.assertIsNone(buffer.since("a", 5))
+        self.assertEqual(buffer.since("a", 12), [{"seq": 13}])
+
+        buffer.append("b", 1, {})
+        buffer.append("c", 1, {})
+        self.assertIsNone(buffer.since("a", 4))
+        self.assertEqual(len(buffer), 2)
+
+    async def test_local_recent_list_needs_a_primed_key(self):
+        recent = RecentList("chat", size=2, ttl_sec=60)
+        await recent.push(None, "a", "lost")
+        self.assertIsNone(await recent.get(None, "a"))
+        await recent.prime(None, "a", ["one"])
+        await recent.push(None, "a", "two")
+        await recent.push(None, "a", "three")
+        self.assertEqual(await recent.get(None, "a"), ["two", "three"])
+
+    def test_prime_seeds_only_unbuffered_keys(self):
+        buffer = ReplayBuffer(size=2)
+        self.assertIsNone(buffer.recent("a"))
+        buffer.prime("a", [(1, "one"), (2, "two"), (3, "three")])
+        self.assertEqual(buffer.recent("a"), ["two", "three"])
+        buffer.prime("a", [(9, "nine")])
+        buffer.prime("b", [])
+        self.assertEqual((buffer.recent("a"), buffer.recent("b")), (["two", "three"], []))
+
+
+class MultiplexConsumerTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.customer = User.objects.create_user(username="customer", password="pass")
+        self.driver = User.objects.create_user(username="driver", password="pass", role=User.Role.DRIVER)
+        self.order = Order.objects.create(
+            customer=self.customer,
+            driver=self.driver,
+            service_type=Order.ServiceType.MOVING,
+            pickup_address="Damascus",
+        )
+        Tracking.objects.create(
+            order=self.order,
+            driver=self.driver,
+            current_latitude=Decimal("33.552516"),
+            current_longitude=Decimal("36.388156"),
+            is_active=True,
+        )
+
+    def _communicator(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope["user"] = user
+        return communicator
+
+    async def test_streams_share_one_socket(self):
+        stream = self._communicator("/ws/stream/", self.customer)
+        connected, _ = await stream.connect()
+        self.assertTrue(connected)
+        tracking, chat = f"tracking:{self.order.id}", f"chat:{self.order.id}"
+
+        await stream.send_json_to({"action": "subscribe", "stream": "tracking", "order": self.order.id})
+        self.assertEqual(await stream.receive_json_from(), {"stream": tracking, "event": "subscribed"})
+        snapshot = await stream.receive_json_from()
+        self.assertEqual((snapshot["stream"], snapshot["payload"]["sequence"]), (tracking, 0))
+        await stream.send_json_to({"action": "subscribe", "stream": "chat", "order": self.order.id})
+        self.assertEqual(await stream.receive_json_from(), {"stream": chat, "event": "subscribed"})
+        history = await stream.receive_json_from()
+        self.assertEqual((history["stream"], history["payload"]["type"]), (chat, "history"))
+
+        driver = self._communicator(f"/ws/tracking/{self.order.id}/", self.driver)
+        await driver.connect()
+        await driver.send_json_to({"current_latitude": 33.5521})
+        update = await stream.receive_json_from()
+        self.assertEqual((update["stream"], update["payload"]["current_latitude"]), (tracking, "33.5521"))
+
+        await stream.send_json_to({"stream": chat, "payload": {"message": "On my way?"}})
+        reply = await stream.receive_json_from()
+        self.assertEqual((reply["stream"], reply["payload"]["message"]), (chat, "On my way?"))
+
+        await stream.send_json_to({"action": "unsubscribe", "stream": "tracking", "order": self.order.id})
+        await driver.send_json_to({"current_latitude": 33.5522})
+        self.assertTrue(await stream.receive_nothing())
+        await driver.disconnect()
+        await stream.disconnect()
+
+    async def test_rejected_stream_reports_close_code(self):
+        stream = self._communicator("/ws/stream/", AnonymousUser())
+        await stream.connect()
+        await stream.send_json_to({"action": "subscribe", "stream": "tracking", "order": self.order.id, "role": "publisher"})
+        self.assertEqual(
+            await stream.receive_json_from(),
+            {"stream": f"tracking:{self.order.id}", "event": "closed", "code": 4003},
+        )
+        await stream.send_json_to({"action": "subscribe", "stream": "video", "order": self.order.id})
+        self.assertEqual((await stream.receive_json_from())["detail"], "Unknown stream.")
+        await stream.disconnect()
+
+    async def test_crashed_stream_is_removed_and_reported(self):
+        async def broken(scope, receive, send):
+            await receive()
+            raise RuntimeError("boom")
+
+        stream = self._communicator("/ws/stream/", self.customer)
+        await stream.connect()
+        closed = {"stream": f"tracking:{self.order.id}", "event": "closed", "code": 1011}
+        with mock.patch.dict(STREAM_APPS, {"tracking": broken}), self.assertLogs("moveline.multiplex", "ERROR"):
+            for _ in range(2):
+                # The second subscribe only starts a stream if the first was removed.
+                await stream.send_json_to({"action": "subscribe", "stream": "tracking", "order": self.order.id})
+                self.assertEqual(await stream.receive_json_from(), closed)
+        await stream.disconnect()
@@ -5,7 +5,9 @@ from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
 
-from ai_analyze.views import AnalyzeImageView, OrderItemViewSet
+from ai_analyze.views import AnalyzeImageView, AnalyzeReadyView, OrderItemViewSet
+from chat.views import ChatMessageViewSet
+from moveline.views import MetricsView
 from orders.views import OrderViewSet, OrderWorkerViewSet
 from payments.views import PaymentViewSet
 from ratings.views import RatingViewSet
@@ -46,6 +48,7 @@ router.register(r"payments", PaymentViewSet)
 router.register(r"tracking", TrackingViewSet)
 router.register(r"order-items", OrderItemViewSet)
 router.register(r"ratings", RatingViewSet)
+router.register(r"chat-messages", ChatMessageViewSet)
 
 
 urlpatterns = [
@@ -77,6 +80,8 @@ urlpatterns = [
         name="applicant_reject",
     ),
     path("api/ai/analyze/", AnalyzeImageView.as_view(), name="ai_analyze"),
+    path("api/ai/ready/", AnalyzeReadyView.as_view(), name="ai_ready"),
+    path("api/metrics/", MetricsView.as_view(), name="metrics"),
     path("api/", include(router.urls)),
 ]
 
@@ -0,0 +1,11 @@
+from rest_framework import permissions, response, status
+from rest_framework.views import APIView
+
+from . import metrics
+
+
+class MetricsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return response.Response(metrics.snapshot(), status=status.HTTP_200_OK)
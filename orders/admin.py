@@ -17,6 +17,7 @@ class OrderAdmin(admin.ModelAdmin):
         "customer",
         "driver",
         "vehicle",
+        "support_agent",
         "created_at",
     )
     list_filter = ("service_type", "status", "created_at")
@@ -40,6 +40,13 @@ class Order(models.Model):
         blank=True,
         related_name="orders",
     )
+    support_agent = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="supported_orders",
+    )
     workers = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
         through="OrderWorker",
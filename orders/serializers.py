@@ -59,6 +59,7 @@ class OrderSerializer(serializers.ModelSerializer):
             "customer",
             "driver",
             "vehicle",
+            "support_agent",
             "workers",
             "required_workers",
             "required_vehicle_type",
@@ -89,6 +90,7 @@ class OrderSerializer(serializers.ModelSerializer):
         )
         read_only_fields = (
             "customer",
+            "support_agent",
             "order_workers",
             "payment",
             "tracking",
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Tracking
+from .models import Tracking, TrackingPoint
 
 
 @admin.register(Tracking)
@@ -15,3 +15,9 @@ class TrackingAdmin(admin.ModelAdmin):
     )
     list_filter = ("is_active",)
     search_fields = ("order__id", "driver__username")
+
+
+@admin.register(TrackingPoint)
+class TrackingPointAdmin(admin.ModelAdmin):
+    list_display = ("tracking", "latitude", "longitude", "speed_kmh", "recorded_at")
+    search_fields = ("tracking__order__id",)
@@ -0,0 +1,200 @@
+"""
+Wire formats for ``TrackingConsumer``.
+
+Clients that do not ask for a subprotocol keep the original JSON text frames.
+Clients that offer ``moveline.tracking.msgpack.v1`` get msgpack binary frames
+with short keys, float coordinates and ``last_ping_at`` as epoch milliseconds:
+
+    o=order, d=driver, la=current_latitude, lo=current_longitude, h=heading,
+    s=speed_kmh, t=last_ping_at, a=is_active, r=remaining_distance_km,
+    q=sequence
+
+The ``-delta`` variants (``moveline.tracking.json-delta.v1`` and
+``moveline.tracking.msgpack-delta.v1``) use the same short keys but send
+scaled integers: ``la``/``lo`` x 1e6, ``h``/``s``/``r`` x 100 and ``t`` in
+epoch milliseconds. A keyframe (``"k": 1``) carries every field as an absolute
+value; the frames after it only carry changed fields, where ``la``, ``lo``,
+``h``, ``s``, ``t``, ``r`` and ``q`` are differences from the previous frame and
+``d``/``a`` are absolute. A keyframe is repeated every
+``DELTA_KEYFRAME_INTERVAL`` frames so clients can resync.
+"""
+
+import json
+from datetime import datetime, timezone
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = "moveline.tracking.msgpack.v1"
+JSON_DELTA_SUBPROTOCOL = "moveline.tracking.json-delta.v1"
+MSGPACK_DELTA_SUBPROTOCOL = "moveline.tracking.msgpack-delta.v1"
+DELTA_KEYFRAME_INTERVAL = 20
+
+SHORT_KEYS = {
+    "order": "o",
+    "driver": "d",
+    "current_latitude": "la",
+    "current_longitude": "lo",
+    "heading": "h",
+    "speed_kmh": "s",
+    "last_ping_at": "t",
+    "is_active": "a",
+    "remaining_distance_km": "r",
+    "sequence": "q",
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+NUMERIC_FIELDS = {"current_latitude", "current_longitude", "heading", "speed_kmh", "remaining_distance_km"}
+DELTA_SCALES = {
+    "current_latitude": 1_000_000,
+    "current_longitude": 1_000_000,
+    "heading": 100,
+    "speed_kmh": 100,
+    "remaining_distance_km": 100,
+}
+DELTA_KEYS = {"la", "lo", "h", "s", "t", "r", "q"}
+
+
+def _to_float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_epoch_ms(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() * 1000)
+
+
+class JsonCodec:
+    subprotocol = None
+
+    def fork(self):
+        return self
+
+    def pack(self, obj) -> dict:
+        return {"text_data": json.dumps(obj, separators=(",", ":"))}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return None
+        payload = json.loads(text_data)
+        return payload if isinstance(payload, dict) else None
+
+    def encode(self, payload) -> dict:
+        return {"text_data": json.dumps(payload)}
+
+
+class MsgpackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def fork(self):
+        return self
+
+    def pack(self, obj) -> dict:
+        return {"bytes_data": msgpack.packb(obj, use_bin_type=True)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if not bytes_data:
+            return None
+        payload = msgpack.unpackb(bytes_data, raw=False)
+        if not isinstance(payload, dict):
+            return None
+        decoded = {LONG_KEYS.get(key, key): value for key, value in payload.items()}
+        if "last_ping_at" in decoded and isinstance(decoded["last_ping_at"], int):
+            decoded["last_ping_at"] = datetime.fromtimestamp(decoded["last_ping_at"] / 1000, tz=timezone.utc).isoformat()
+        return decoded
+
+    def encode(self, payload) -> dict:
+        packed = {}
+        for key, value in payload.items():
+            if key in NUMERIC_FIELDS:
+                value = _to_float(value)
+            elif key == "last_ping_at":
+                value = _to_epoch_ms(value)
+            packed[SHORT_KEYS.get(key, key)] = value
+        return self.pack(packed)
+
+
+class DeltaCodec:
+    """
+    Per-connection encoder for the ``-delta`` subprotocols. Inbound frames
+    are decoded by the wrapped codec unchanged.
+    """
+
+    __slots__ = ("inner", "subprotocol", "_last", "_frames_since_keyframe")
+
+    def __init__(self, inner, subprotocol):
+        self.inner = inner
+        self.subprotocol = subprotocol
+        self._last = None
+        self._frames_since_keyframe = 0
+
+    def fork(self):
+        return DeltaCodec(self.inner, self.subprotocol)
+
+    def pack(self, obj) -> dict:
+        # Control frames are sent as-is and do not touch the delta state.
+        return self.inner.pack(obj)
+
+    def decode(self, text_data=None, bytes_data=None):
+        return self.inner.decode(text_data, bytes_data)
+
+    def encode(self, payload) -> dict:
+        state = self._scaled(payload)
+        last = self._last
+        self._last = state
+        if self._needs_keyframe(last, state):
+            self._frames_since_keyframe = 0
+            return self.inner.pack({"k": 1, **state})
+
+        self._frames_since_keyframe += 1
+        frame = {}
+        for key, value in state.items():
+            previous = last.get(key)
+            if value == previous:
+                continue
+            frame[key] = value - previous if key in DELTA_KEYS else value
+        return self.inner.pack(frame)
+
+    def _needs_keyframe(self, last, state) -> bool:
+        if last is None or self._frames_since_keyframe + 1 >= DELTA_KEYFRAME_INTERVAL:
+            return True
+        if last.keys() != state.keys() or last.get("o") != state.get("o"):
+            return True
+        # A delta cannot express a field appearing or disappearing.
+        return any((last[key] is None) != (state[key] is None) for key in DELTA_KEYS if key in state)
+
+    @staticmethod
+    def _scaled(payload) -> dict:
+        state = {}
+        for key, value in payload.items():
+            if key in DELTA_SCALES:
+                value = _to_float(value)
+                if value is not None:
+                    value = round(value * DELTA_SCALES[key])
+            elif key == "last_ping_at":
+                value = _to_epoch_ms(value)
+            state[SHORT_KEYS.get(key, key)] = value
+        return state
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+CODECS = {
+    MSGPACK_SUBPROTOCOL: MSGPACK_CODEC,
+    JSON_DELTA_SUBPROTOCOL: DeltaCodec(JSON_CODEC, JSON_DELTA_SUBPROTOCOL),
+    MSGPACK_DELTA_SUBPROTOCOL: DeltaCodec(MSGPACK_CODEC, MSGPACK_DELTA_SUBPROTOCOL),
+}
+
+
+def negotiate_codec(scope):
+    for subprotocol in scope.get("subprotocols", ()):
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec.fork()
+    return JSON_CODEC
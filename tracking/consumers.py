@@ -1,106 +1,220 @@
+import asyncio
+import functools
 import json
-from urllib.parse import urlencode
+import sys
+import time
+from urllib.parse import parse_qs, urlencode
 from urllib.request import Request, urlopen
 
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.utils import timezone
 
+from .codecs import negotiate_codec
+from .geo import haversine_km
+from .geofence import GeofenceEngine, advance_order
+from .ingest import MAX_BATCH_POINTS, ingest_batch
 from .models import Tracking
+from .pacing import recommend_ping_interval
+from .tiles import FLEET_ALL_GROUP, index_tiles, tile_bbox, tile_for, tile_group, tiles_for_bbox
+from moveline import metrics
+from moveline.layers import group_size
+from moveline.outbound import OutboundQueueMixin
+from moveline.replay import ReplayBuffer
 from orders.models import Order
 
+PING_FIELDS = ("current_latitude", "current_longitude", "heading", "speed_kmh", "is_active")
+FLEET_FLUSH_INTERVAL_SEC = 1.0
+FLEET_SNAPSHOT_LIMIT = 5000
+WATCHER_COUNT_TTL_SEC = 10.0
+
+# Recent broadcasts per order, fed by every tracking consumer in this process.
+replay_buffer = ReplayBuffer(size=64)
+
+
+class TrackingConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
+    """
+    Every broadcast carries the order's ``sequence``. A subscriber that
+    reconnects with ``?last_seq=<n>`` is sent only the updates it missed from
+    the process-local replay buffer, falling back to the usual snapshot when
+    the buffer cannot bridge the gap. With ``?role=subscriber`` such a resume
+    does not touch the database or the router.
+    """
+
+    # Positions supersede each other, so a slow client just loses old ones.
+    outbound_limit = 16
+    outbound_metrics_prefix = "tracking"
+
+    # Defaults live on the class so an idle subscriber only carries the few
+    # attributes it sets; the publisher-side state is filled in on demand.
+    is_publisher = False
+    subscribed = False
+    last_sequence = None
+    tracking_state = None
+    dropoff = None
+    geofence = None
+    order_status = None
+    order_driver_id = None
+    fleet_tile = None
+    ping_interval = None
+    watchers = None
+    watchers_checked_at = None
 
-class TrackingConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
-        self.group_name = f"tracking_{self.order_id}"
+        # Every watcher of an order shares one copy of these strings.
+        self.order_id = sys.intern(self.scope["url_route"]["kwargs"]["order_id"])
+        self.group_name = sys.intern(f"tracking_{self.order_id}")
+        self.codec = negotiate_codec(self.scope)
+        metrics.ensure_loop_monitor(self.channel_layer)
 
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        query = parse_qs(self.scope.get("query_string", b"").decode("latin-1"))
+        self.is_publisher = await self._resolve_role(query)
+        if self.is_publisher is None:
+            await self.close(code=4003)
+            return
+
+        # Publishers never join the broadcast group, so drivers do not get
+        # their own pings echoed back.
+        if not self.is_publisher:
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            self.subscribed = True
+        await self.accept(subprotocol=self.codec.subprotocol)
 
-        tracking = await self._get_tracking()
-        if tracking:
-            remaining_km = await self._remaining_distance_km(tracking)
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "order": tracking.order_id,
-                        "driver": tracking.driver_id,
-                        "current_latitude": str(tracking.current_latitude) if tracking.current_latitude is not None else None,
-                        "current_longitude": str(tracking.current_longitude) if tracking.current_longitude is not None else None,
-                        "heading": str(tracking.heading) if tracking.heading is not None else None,
-                        "speed_kmh": str(tracking.speed_kmh) if tracking.speed_kmh is not None else None,
-                        "last_ping_at": tracking.last_ping_at.isoformat() if tracking.last_ping_at else None,
-                        "is_active": tracking.is_active,
-                        "remaining_distance_km": remaining_km,
-                    }
-                )
+        if not self.is_publisher:
+            missed = self._missed_updates(query)
+            if missed is not None:
+                metrics.increment("tracking.resumed")
+                for payload in missed:
+                    await self._send_update(payload)
+                return
+
+        state = self.tracking_state or await self._load_tracking()
+        if state:
+            self.last_sequence = state["sequence"]
+            payload = dict(state)
+            payload["remaining_distance_km"] = await self._remaining_distance_km(
+                state["current_latitude"],
+                state["current_longitude"],
             )
+            await self.send(**self.codec.encode(payload))
+            if self.is_publisher:
+                await self._send_ping_interval(payload)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if self.subscribed:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
-        if not text_data:
+        if not self.is_publisher:
+            metrics.increment("tracking.rejected_subscriber_messages")
             return
-        payload = json.loads(text_data)
+        with metrics.timer("tracking.receive"):
+            await self._handle_publish(text_data, bytes_data)
 
-        updated = await self._update_tracking(payload)
+    async def _handle_publish(self, text_data, bytes_data):
+        with metrics.timer("tracking.receive.parse"):
+            payload = self.codec.decode(text_data, bytes_data)
+        if payload is None:
+            return
+        with metrics.timer("tracking.receive.db"):
+            if payload.get("type") == "batch":
+                updated = await self._ingest_batch(payload.get("points"))
+            else:
+                metrics.increment("tracking.pings")
+                updated = await self._update_tracking(payload)
         if updated is None:
             return
 
-        remaining_km = await self._remaining_distance_km_from_payload(updated)
-        updated["remaining_distance_km"] = remaining_km
+        with metrics.timer("tracking.receive.routing"):
+            updated["remaining_distance_km"] = await self._remaining_distance_km(
+                updated["current_latitude"],
+                updated["current_longitude"],
+            )
 
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                "type": "tracking.update",
-                "payload": updated,
-            },
+        replay_buffer.append(self.order_id, updated["sequence"], updated)
+        with metrics.timer("tracking.receive.group_send"):
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    "type": "tracking.update",
+                    "payload": updated,
+                },
+            )
+            await self._publish_fleet(updated)
+        await self._send_ping_interval(updated)
+
+    async def _send_ping_interval(self, state):
+        distance_km = state.get("remaining_distance_km")
+        if distance_km is None:
+            distance_km = self._straight_line_km(state)
+        speed_kmh = state.get("speed_kmh")
+        interval = recommend_ping_interval(
+            speed_kmh=float(speed_kmh) if speed_kmh is not None else None,
+            distance_km=distance_km,
+            watchers=await self._watcher_count(),
+            is_active=state.get("is_active", True),
         )
+        if interval == self.ping_interval:
+            return
+        self.ping_interval = interval
+        metrics.increment("tracking.ping_interval.sent")
+        await self.send(**self.codec.pack({"type": "ping_interval", "seconds": interval}))
 
-    async def tracking_update(self, event):
-        await self.send(text_data=json.dumps(event["payload"]))
+    async def _watcher_count(self):
+        # Asking the layer is a round trip on the shared broker, so the
+        # answer is reused for a few seconds.
+        now = time.monotonic()
+        if self.watchers_checked_at is None or now - self.watchers_checked_at > WATCHER_COUNT_TTL_SEC:
+            self.watchers = await group_size(self.channel_layer, self.group_name)
+            self.watchers_checked_at = now
+        return self.watchers
 
-    @sync_to_async
-    def _get_tracking(self):
-        try:
-            return Tracking.objects.select_related("order", "driver").get(order_id=self.order_id)
-        except Tracking.DoesNotExist:
+    def _straight_line_km(self, state):
+        if self.dropoff is None or state.get("current_latitude") is None or state.get("current_longitude") is None:
             return None
+        return haversine_km(state["current_latitude"], state["current_longitude"], *self.dropoff)
 
-    @sync_to_async
-    def _update_tracking(self, payload):
-        try:
-            tracking = Tracking.objects.select_related("order", "driver").get(order_id=self.order_id)
-        except Tracking.DoesNotExist:
-            return None
+    async def _publish_fleet(self, payload):
+        tile = None
+        if payload.get("current_latitude") is not None and payload.get("current_longitude") is not None:
+            tile = tile_for(payload["current_latitude"], payload["current_longitude"])
+        groups = {FLEET_ALL_GROUP}
+        if tile is not None:
+            groups.add(tile_group(*tile))
+        # Watchers of the tile the vehicle just left need the update too, so
+        # they can drop it from their map.
+        if self.fleet_tile is not None and self.fleet_tile != tile:
+            groups.add(tile_group(*self.fleet_tile))
+        self.fleet_tile = tile
+        for group in groups:
+            await self.channel_layer.group_send(group, {"type": "fleet.update", "payload": payload})
+
+    async def tracking_update(self, event):
+        payload = event["payload"]
+        replay_buffer.append(self.order_id, payload["sequence"], payload)
+        if self.last_sequence is not None and payload["sequence"] <= self.last_sequence:
+            return
+        self.last_sequence = payload["sequence"]
+        # Encoded when sent: a delta computed against a frame that is later
+        # dropped would leave the client on a wrong position.
+        await self.queue_send(encode=functools.partial(self.codec.encode, payload))
 
-        fields = {}
-        if "current_latitude" in payload:
-            fields["current_latitude"] = payload.get("current_latitude")
-        if "current_longitude" in payload:
-            fields["current_longitude"] = payload.get("current_longitude")
-        if "heading" in payload:
-            fields["heading"] = payload.get("heading")
-        if "speed_kmh" in payload:
-            fields["speed_kmh"] = payload.get("speed_kmh")
-        if "is_active" in payload:
-            fields["is_active"] = payload.get("is_active")
+    async def tracking_event(self, event):
+        await self.queue_send(**self.codec.pack(event["event"]))
 
-        if fields:
-            for key, value in fields.items():
-                setattr(tracking, key, value)
-            tracking.last_ping_at = timezone.now()
-            tracking.save(update_fields=(*fields.keys(), "last_ping_at"))
+    async def _send_update(self, payload):
+        self.last_sequence = payload["sequence"]
+        await self.send(**self.codec.encode(payload))
 
-            order = tracking.order
-            if self._is_at_dropoff(order, tracking):
-                if order.status != Order.Status.DELIVERED:
-                    order.status = Order.Status.DELIVERED
-                    order.save(update_fields=("status",))
+    def _missed_updates(self, query):
+        try:
+            last_sequence = int(query["last_seq"][0])
+        except (KeyError, ValueError):
+            return None
+        return replay_buffer.since(self.order_id, last_sequence)
 
+    @staticmethod
+    def _tracking_payload(tracking):
         return {
             "order": tracking.order_id,
             "driver": tracking.driver_id,
@@ -110,52 +224,152 @@ class TrackingConsumer(AsyncWebsocketConsumer):
             "speed_kmh": str(tracking.speed_kmh) if tracking.speed_kmh is not None else None,
             "last_ping_at": tracking.last_ping_at.isoformat() if tracking.last_ping_at else None,
             "is_active": tracking.is_active,
+            "sequence": tracking.sequence,
         }
 
-    def _is_at_dropoff(self, order, tracking) -> bool:
-        if (
-            order.dropoff_latitude is None
-            or order.dropoff_longitude is None
-            or tracking.current_latitude is None
-            or tracking.current_longitude is None
-        ):
+    async def _resolve_role(self, query):
+        """
+        ``True`` for a publisher, ``False`` for a subscriber and ``None`` when
+        the requested role is not allowed. The order's driver publishes by
+        default; staff may publish with ``?role=publisher``.
+        """
+        requested = (query.get("role") or [None])[0]
+        if requested == "subscriber":
             return False
-        try:
-            dropoff_lat = round(float(order.dropoff_latitude), 5)
-            dropoff_lon = round(float(order.dropoff_longitude), 5)
-            current_lat = round(float(tracking.current_latitude), 5)
-            current_lon = round(float(tracking.current_longitude), 5)
-        except (TypeError, ValueError):
-            return False
-        return dropoff_lat == current_lat and dropoff_lon == current_lon
 
-    @sync_to_async
-    def _remaining_distance_km_from_payload(self, payload):
-        try:
-            tracking = Tracking.objects.select_related("order").get(order_id=self.order_id)
-        except Tracking.DoesNotExist:
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            return None if requested == "publisher" else False
+        if self.tracking_state is None and await self._load_tracking() is None:
+            self.order_driver_id = await Order.objects.filter(pk=self.order_id).values_list("driver_id", flat=True).afirst()
+        tracking_driver_id = self.tracking_state["driver"] if self.tracking_state else None
+        is_driver = user.pk in (self.order_driver_id, tracking_driver_id)
+
+        if requested == "publisher":
+            return True if is_driver or user.is_staff or user.role == user.Role.ADMIN else None
+        return is_driver
+
+    async def _load_tracking(self):
+        tracking = await Tracking.objects.select_related("order").filter(order_id=self.order_id).afirst()
+        if tracking is None:
             return None
-        return self._osrm_distance_to_dropoff(
-            tracking,
-            payload.get("current_latitude"),
-            payload.get("current_longitude"),
-        )
+        return self._remember_tracking(tracking)
+
+    def _remember_tracking(self, tracking):
+        order = tracking.order
+        if order.dropoff_latitude is not None and order.dropoff_longitude is not None:
+            self.dropoff = (order.dropoff_latitude, order.dropoff_longitude)
+        self.geofence = GeofenceEngine.for_order(order)
+        self.geofence.seed(tracking.current_latitude, tracking.current_longitude)
+        self.order_status = order.status
+        self.order_driver_id = order.driver_id
+        self.tracking_state = self._tracking_payload(tracking)
+        return self.tracking_state
+
+    async def _update_tracking(self, payload):
+        # The record is read once per connection (again only after another
+        # writer changed it); each ping is then a single UPDATE applied to
+        # the cached copy.
+        fields = {key: payload.get(key) for key in PING_FIELDS if key in payload}
+        now = timezone.now()
+        state = await sync_to_async(self._save_ping)(fields, now)
+        if state is None:
+            return None
+
+        if fields:
+            for key, value in fields.items():
+                if key == "is_active":
+                    state[key] = value
+                else:
+                    state[key] = str(value) if value is not None else None
+            state["last_ping_at"] = now.isoformat()
+            await self._apply_geofence([(state["current_latitude"], state["current_longitude"])])
 
-    @sync_to_async
-    def _remaining_distance_km(self, tracking):
-        return self._osrm_distance_to_dropoff(
-            tracking,
-            str(tracking.current_latitude) if tracking.current_latitude is not None else None,
-            str(tracking.current_longitude) if tracking.current_longitude is not None else None,
+        return dict(state)
+
+    @metrics.counts_queries("tracking.ping.db_queries")
+    def _save_ping(self, fields, now):
+        # Every query a ping needs runs in this one hop to the DB thread, so
+        # the counter above measures them all.
+        if self.tracking_state is None:
+            tracking = Tracking.objects.select_related("order").filter(order_id=self.order_id).first()
+            if tracking is None:
+                return None
+            self._remember_tracking(tracking)
+        if fields:
+            # The update only applies on top of the record this connection
+            # last saw, so the broadcast is what is stored. When another
+            # writer got there first, reload its record and apply on top.
+            while not Tracking.objects.filter(order_id=self.order_id, sequence=self.tracking_state["sequence"]).update(
+                **fields,
+                last_ping_at=now,
+                updated_at=now,
+                sequence=self.tracking_state["sequence"] + 1,
+            ):
+                tracking = Tracking.objects.select_related("order").filter(order_id=self.order_id).first()
+                if tracking is None:
+                    self.tracking_state = None
+                    return None
+                self._remember_tracking(tracking)
+            self.tracking_state["sequence"] += 1
+        return self.tracking_state
+
+    async def _ingest_batch(self, points):
+        """
+        Offline-buffered points arrive as ``{"type": "batch", "points": [...]}``
+        and are written in one transaction; see ``tracking.ingest``.
+        """
+        if not isinstance(points, list) or len(points) > MAX_BATCH_POINTS:
+            await self.send(**self.codec.pack({"type": "error", "detail": "Invalid batch."}))
+            return None
+        if self.tracking_state is None and await self._load_tracking() is None:
+            return None
+        result = await sync_to_async(ingest_batch)(self.order_id, points, self.tracking_state["is_active"])
+        await self.send(
+            **self.codec.pack({"type": "batch_ack", "accepted": result["accepted"], "rejected": result["rejected"]})
         )
+        latest = result["latest"]
+        if latest is None:
+            return None
 
-    def _osrm_distance_to_dropoff(self, tracking, current_lat, current_lon):
-        order = tracking.order
-        if not (order.dropoff_latitude and order.dropoff_longitude and current_lat and current_lon):
+        state = self.tracking_state
+        for key, value in latest.items():
+            if key == "last_ping_at":
+                state[key] = value.isoformat()
+            elif key in ("is_active", "sequence"):
+                state[key] = value
+            else:
+                state[key] = str(value) if value is not None else None
+        await self._apply_geofence(result["track"])
+        return dict(state)
+
+    async def _apply_geofence(self, positions):
+        if self.geofence is None:
+            return
+        for lat, lon in positions:
+            for fence, event in self.geofence.update(lat, lon):
+                metrics.increment(f"tracking.geofence.{fence}.{event}")
+                self.order_status = await sync_to_async(self._advance_order)(fence, event)
+                message = {"type": "geofence", "fence": fence, "event": event, "order_status": self.order_status}
+                await self.send(**self.codec.pack(message))
+                await self.channel_layer.group_send(self.group_name, {"type": "tracking.event", "event": message})
+
+    @metrics.counts_queries("tracking.ping.db_queries")
+    def _advance_order(self, fence, event):
+        return advance_order(self.order_id, self.order_status, fence, event)
+
+    async def _remaining_distance_km(self, current_lat, current_lon):
+        # OSRM is plain HTTP, so it runs outside the thread-sensitive executor
+        # and never queues up behind (or blocks) database work.
+        return await sync_to_async(self._osrm_distance_to_dropoff, thread_sensitive=False)(current_lat, current_lon)
+
+    def _osrm_distance_to_dropoff(self, current_lat, current_lon):
+        if not (self.dropoff and current_lat and current_lon):
             return None
+        dropoff_lat, dropoff_lon = self.dropoff
 
         base_url = "http://router.project-osrm.org/route/v1/driving/"
-        coords = f"{current_lon},{current_lat};{order.dropoff_longitude},{order.dropoff_latitude}"
+        coords = f"{current_lon},{current_lat};{dropoff_lon},{dropoff_lat}"
         query = urlencode({"overview": "false"})
         url = f"{base_url}{coords}?{query}"
         try:
@@ -172,3 +386,136 @@ class TrackingConsumer(AsyncWebsocketConsumer):
         if distance_meters is None:
             return None
         return round(distance_meters / 1000.0, 2)
+
+
+class FleetConsumer(AsyncWebsocketConsumer):
+    """
+    Live map of every active vehicle for ops staff. Clients send
+    ``{"action": "subscribe", "bbox": [min_lon, min_lat, max_lon, max_lat]}``
+    or ``{"action": "subscribe", "tiles": [[z, x, y], ...]}`` and receive a
+    snapshot followed by coalesced ``fleet.update`` frames once per
+    ``FLEET_FLUSH_INTERVAL_SEC``. Vehicles that leave the viewport or stop
+    tracking are reported as ``{"order": id, "removed": true}``.
+    """
+
+    async def connect(self):
+        user = self.scope.get("user")
+        if not (user and user.is_authenticated and (user.is_staff or user.role == user.Role.ADMIN)):
+            await self.close(code=4003)
+            return
+
+        self.fleet_groups = set()
+        self.bbox = None
+        self.visible = set()
+        self.pending = {}
+        await self.accept()
+        self.flush_task = asyncio.create_task(self._flush_forever())
+
+    async def disconnect(self, close_code):
+        flush_task = getattr(self, "flush_task", None)
+        if flush_task is not None:
+            flush_task.cancel()
+        await self._join_groups(set())
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data:
+            return
+        try:
+            payload = json.loads(text_data)
+        except ValueError:
+            return
+        action = payload.get("action") if isinstance(payload, dict) else None
+        if action == "subscribe":
+            await self._subscribe(payload)
+        elif action == "unsubscribe":
+            await self._join_groups(set())
+            self.bbox = None
+            self.visible.clear()
+            self.pending.clear()
+
+    async def _subscribe(self, payload):
+        try:
+            if payload.get("bbox") is not None:
+                min_lon, min_lat, max_lon, max_lat = (float(value) for value in payload["bbox"])
+                tiles = tiles_for_bbox(min_lon, min_lat, max_lon, max_lat)
+            else:
+                requested = [tuple(int(part) for part in tile) for tile in payload.get("tiles") or ()]
+                if not requested:
+                    raise ValueError
+                tiles = index_tiles(requested)
+                corners = [tile_bbox(x, y, z) for z, x, y in requested]
+                min_lon = min(corner[0] for corner in corners)
+                min_lat = min(corner[1] for corner in corners)
+                max_lon = max(corner[2] for corner in corners)
+                max_lat = max(corner[3] for corner in corners)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({"type": "error", "detail": "Invalid subscription."}))
+            return
+
+        self.bbox = (min_lon, min_lat, max_lon, max_lat)
+        # Viewports too large for the tile index listen to every vehicle and
+        # rely on the bbox filter alone.
+        groups = {FLEET_ALL_GROUP} if tiles is None else {tile_group(x, y) for x, y in tiles}
+        await self._join_groups(groups)
+
+        vehicles = await self._active_in_bbox(self.bbox)
+        self.pending.clear()
+        self.visible = {vehicle["order"] for vehicle in vehicles}
+        await self.send(text_data=json.dumps({"type": "fleet.snapshot", "vehicles": vehicles}))
+
+    async def _join_groups(self, groups):
+        for group in self.fleet_groups - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - self.fleet_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.fleet_groups = groups
+
+    def _in_view(self, payload) -> bool:
+        if self.bbox is None or not payload.get("is_active"):
+            return False
+        lat, lon = payload.get("current_latitude"), payload.get("current_longitude")
+        if lat is None or lon is None:
+            return False
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return min_lat <= float(lat) <= max_lat and min_lon <= float(lon) <= max_lon
+
+    async def fleet_update(self, event):
+        payload = event["payload"]
+        order = payload.get("order")
+        if self._in_view(payload):
+            self.pending[order] = payload
+        elif order in self.visible or order in self.pending:
+            self.pending[order] = {"order": order, "removed": True}
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(FLEET_FLUSH_INTERVAL_SEC)
+            if not self.pending:
+                continue
+            vehicles = list(self.pending.values())
+            self.pending = {}
+            for vehicle in vehicles:
+                if vehicle.get("removed"):
+                    self.visible.discard(vehicle["order"])
+                else:
+                    self.visible.add(vehicle["order"])
+            await self.send(text_data=json.dumps({"type": "fleet.update", "vehicles": vehicles}))
+
+    async def _active_in_bbox(self, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        trackings = Tracking.objects.filter(
+            is_active=True,
+            current_latitude__range=(min_lat, max_lat),
+            current_longitude__range=(min_lon, max_lon),
+        ).only(
+            "order",
+            "driver",
+            "current_latitude",
+            "current_longitude",
+            "heading",
+            "speed_kmh",
+            "last_ping_at",
+            "is_active",
+            "sequence",
+        )[:FLEET_SNAPSHOT_LIMIT]
+        return [TrackingConsumer._tracking_payload(tracking) async for tracking in trackings]
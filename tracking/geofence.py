@@ -0,0 +1,122 @@
+"""
+Pickup and dropoff geofences for live orders.
+
+Orders only store points, so each fence is a circle. Membership uses an
+equirectangular projection around the fence centre, which is accurate to well
+under a metre at these radii and costs a handful of float operations per ping.
+A vehicle arrives once ``ARRIVAL_CONFIRMATIONS`` consecutive pings fall inside
+``enter_m`` and departs only when it is further than ``exit_m``, so GPS jitter
+at the edge does not flap.
+"""
+
+import math
+
+from orders.models import Order
+
+METERS_PER_DEGREE = 111_320.0
+PICKUP_RADIUS_M = (75, 150)
+DROPOFF_RADIUS_M = (75, 150)
+ARRIVAL_CONFIRMATIONS = 2
+
+ARRIVED = "arrived"
+DEPARTED = "departed"
+
+# (fence, event) -> (new status, statuses it may replace)
+ORDER_TRANSITIONS = {
+    ("pickup", DEPARTED): (Order.Status.IN_PROGRESS, (Order.Status.ASSIGNED,)),
+    ("dropoff", ARRIVED): (Order.Status.DELIVERED, (Order.Status.ASSIGNED, Order.Status.IN_PROGRESS)),
+}
+
+
+class CircleFence:
+    __slots__ = ("name", "lat", "lon", "kx", "enter_sq", "exit_sq", "inside", "streak")
+
+    def __init__(self, name, lat, lon, enter_m, exit_m):
+        self.name = name
+        self.lat = float(lat)
+        self.lon = float(lon)
+        self.kx = METERS_PER_DEGREE * math.cos(math.radians(self.lat))
+        self.enter_sq = enter_m * enter_m
+        self.exit_sq = exit_m * exit_m
+        self.inside = False
+        self.streak = 0
+
+    def distance_sq(self, lat, lon):
+        dx = (lon - self.lon) * self.kx
+        dy = (lat - self.lat) * METERS_PER_DEGREE
+        return dx * dx + dy * dy
+
+    def seed(self, lat, lon):
+        self.inside = self.distance_sq(lat, lon) <= self.enter_sq
+        self.streak = 0
+
+    def update(self, lat, lon, confirmations):
+        distance_sq = self.distance_sq(lat, lon)
+        if self.inside:
+            if distance_sq > self.exit_sq:
+                self.inside = False
+                return DEPARTED
+            return None
+        if distance_sq > self.enter_sq:
+            self.streak = 0
+            return None
+        self.streak += 1
+        if self.streak < confirmations:
+            return None
+        self.inside = True
+        self.streak = 0
+        return ARRIVED
+
+
+class GeofenceEngine:
+    def __init__(self, fences, confirmations=ARRIVAL_CONFIRMATIONS):
+        self.fences = fences
+        self.confirmations = confirmations
+
+    @classmethod
+    def for_order(cls, order):
+        fences = []
+        if order.pickup_latitude is not None and order.pickup_longitude is not None:
+            fences.append(CircleFence("pickup", order.pickup_latitude, order.pickup_longitude, *PICKUP_RADIUS_M))
+        if order.dropoff_latitude is not None and order.dropoff_longitude is not None:
+            fences.append(CircleFence("dropoff", order.dropoff_latitude, order.dropoff_longitude, *DROPOFF_RADIUS_M))
+        return cls(fences)
+
+    def seed(self, lat, lon):
+        """
+        Start from a known position without emitting events, so a vehicle
+        that is already inside a fence can depart from it.
+        """
+        if lat is None or lon is None:
+            return
+        for fence in self.fences:
+            fence.seed(float(lat), float(lon))
+
+    def update(self, lat, lon):
+        """Feed one position and return the ``(fence, event)`` pairs it caused."""
+        if lat is None or lon is None or not self.fences:
+            return []
+        lat, lon = float(lat), float(lon)
+        events = []
+        for fence in self.fences:
+            event = fence.update(lat, lon, self.confirmations)
+            if event is not None:
+                events.append((fence.name, event))
+        return events
+
+
+def advance_order(order_id, status, fence, event):
+    """
+    Apply the status change a fence event implies and return the order's
+    status afterwards. ``status`` is the caller's last known status, returned
+    as is for events that change nothing.
+    """
+    transition = ORDER_TRANSITIONS.get((fence, event))
+    if transition is None:
+        return status
+    new_status, allowed = transition
+    # The conditional update is the guard: the caller's status may be stale
+    # when the order was assigned or started elsewhere.
+    if Order.objects.filter(pk=order_id, status__in=allowed).update(status=new_status):
+        return new_status
+    return Order.objects.filter(pk=order_id).values_list("status", flat=True).first() or status
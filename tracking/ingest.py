@@ -0,0 +1,182 @@
+"""
+Batched ingestion of offline-buffered driver positions.
+
+A batch is a list of points such as
+``{"current_latitude": 33.55, "current_longitude": 36.38, "heading": 90,
+"speed_kmh": 20, "recorded_at": 1767000000000}`` (msgpack clients may use the
+short keys ``la``, ``lo``, ``h``, ``s`` and ``t``). ``recorded_at`` is epoch
+milliseconds or an ISO 8601 string. The batch is validated column-wise with
+numpy, the newest point is applied to ``Tracking`` (unless the record already
+has a newer ping) and the rest are bulk-inserted into ``TrackingPoint``.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .codecs import LONG_KEYS
+from .models import Tracking, TrackingPoint
+from moveline import metrics
+
+MAX_BATCH_POINTS = 1000
+MAX_SPEED_KMH = 300
+MAX_POINT_AGE = timedelta(days=7)
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+BULK_CREATE_BATCH_SIZE = 500
+
+
+def _float(value):
+    try:
+        return float(value) if value is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _epoch_ms(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return np.nan
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=dt_timezone.utc)
+        return parsed.timestamp() * 1000
+    return np.nan
+
+
+def _column(points, key, convert):
+    return np.fromiter((convert(point.get(key)) for point in points), dtype=np.float64, count=len(points))
+
+
+def validate_batch(points, now=None):
+    """
+    Return ``(columns, rejected)`` where ``columns`` holds the valid points as
+    numpy arrays sorted by time with duplicate timestamps removed.
+    """
+    now = now or timezone.now()
+    points = [
+        {LONG_KEYS.get(key, key): value for key, value in point.items()} if isinstance(point, dict) else {}
+        for point in points
+    ]
+    for point in points:
+        if "recorded_at" not in point and "last_ping_at" in point:
+            point["recorded_at"] = point["last_ping_at"]
+
+    lat = _column(points, "current_latitude", _float)
+    lon = _column(points, "current_longitude", _float)
+    heading = _column(points, "heading", _float)
+    speed = _column(points, "speed_kmh", _float)
+    recorded = _column(points, "recorded_at", _epoch_ms)
+
+    oldest = (now - MAX_POINT_AGE).timestamp() * 1000
+    newest = (now + MAX_CLOCK_SKEW).timestamp() * 1000
+    valid = (
+        (np.abs(lat) <= 90)
+        & (np.abs(lon) <= 180)
+        & (np.isnan(heading) | ((heading >= 0) & (heading < 360)))
+        & (np.isnan(speed) | ((speed >= 0) & (speed <= MAX_SPEED_KMH)))
+        & (recorded >= oldest)
+        & (recorded <= newest)
+    )
+
+    order = np.argsort(recorded[valid], kind="stable")
+    columns = {
+        "latitude": lat[valid][order],
+        "longitude": lon[valid][order],
+        "heading": heading[valid][order],
+        "speed_kmh": speed[valid][order],
+        "recorded_at": recorded[valid][order].astype(np.int64),
+    }
+    if len(order):
+        # Keep the last point reported for each millisecond.
+        keep = np.append(columns["recorded_at"][1:] != columns["recorded_at"][:-1], True)
+        columns = {key: column[keep] for key, column in columns.items()}
+    return columns, len(points) - len(columns["recorded_at"])
+
+
+def _decimal(value, places):
+    return None if np.isnan(value) else Decimal(f"{value:.{places}f}")
+
+
+def _datetime(epoch_ms):
+    return datetime.fromtimestamp(int(epoch_ms) / 1000, tz=dt_timezone.utc)
+
+
+@metrics.counts_queries("tracking.batch.db_queries")
+def ingest_batch(order_id, points, is_active=True):
+    """
+    Apply a batch to the order's tracking record. Returns a dict with the
+    ``accepted`` and ``rejected`` counts and, when the newest point was
+    applied to ``Tracking``, its fields (with the stored ``sequence``) under
+    ``latest`` and the batch's ``(lat, lon)`` positions, oldest first, under
+    ``track``.
+    """
+    columns, rejected = validate_batch(points)
+    accepted = len(columns["recorded_at"])
+    result = {"accepted": accepted, "rejected": rejected, "latest": None, "track": []}
+    if not accepted:
+        return result
+
+    rows = [
+        {
+            "latitude": _decimal(lat, 6),
+            "longitude": _decimal(lon, 6),
+            "heading": _decimal(heading, 2),
+            "speed_kmh": _decimal(speed, 2),
+            "recorded_at": _datetime(recorded_at),
+        }
+        for lat, lon, heading, speed, recorded_at in zip(
+            columns["latitude"].tolist(),
+            columns["longitude"].tolist(),
+            columns["heading"].tolist(),
+            columns["speed_kmh"].tolist(),
+            columns["recorded_at"].tolist(),
+        )
+    ]
+    newest = rows[-1]
+
+    with transaction.atomic():
+        applied = Tracking.objects.filter(
+            Q(last_ping_at__isnull=True) | Q(last_ping_at__lt=newest["recorded_at"]),
+            order_id=order_id,
+        ).update(
+            current_latitude=newest["latitude"],
+            current_longitude=newest["longitude"],
+            heading=newest["heading"],
+            speed_kmh=newest["speed_kmh"],
+            is_active=is_active,
+            last_ping_at=newest["recorded_at"],
+            updated_at=timezone.now(),
+            sequence=F("sequence") + 1,
+        )
+        if applied:
+            # Read back inside the transaction: the row stays locked by the
+            # update, so this is the sequence our update stored.
+            sequence = Tracking.objects.filter(order_id=order_id).values_list("sequence", flat=True).get()
+        history = rows[:-1] if applied else rows
+        if history:
+            TrackingPoint.objects.bulk_create(
+                [TrackingPoint(tracking_id=order_id, **row) for row in history],
+                batch_size=BULK_CREATE_BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+
+    metrics.increment("tracking.batch.points", accepted)
+    if applied:
+        result["latest"] = {
+            "current_latitude": newest["latitude"],
+            "current_longitude": newest["longitude"],
+            "heading": newest["heading"],
+            "speed_kmh": newest["speed_kmh"],
+            "is_active": is_active,
+            "last_ping_at": newest["recorded_at"],
+            "sequence": sequence,
+        }
+        result["track"] = list(zip(columns["latitude"].tolist(), columns["longitude"].tolist()))
+    return result
@@ -0,0 +1,245 @@
+"""
+Load generator for the tracking websocket.
+
+Simulates drivers replaying the densified route from ``ttt.py`` and customers
+watching the same orders, then prints a JSON report with ping-to-broadcast
+latency percentiles, throughput, missed broadcasts and (when an admin token
+is given) the server's DB queries per ping from ``/api/metrics/``.
+
+    python -m tracking.loadtest --orders 100-149 --drivers 1 --subscribers 5 \
+        --interval 0.5 --token <admin-jwt> --output report.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+from urllib.request import Request, urlopen
+
+import websockets
+
+from tracking.ttt import ROUTE_POINTS, densify
+
+DRIVER_OFFSET_DEG = 0.00001
+
+
+def parse_orders(value):
+    orders = []
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-", 1)
+            orders.extend(range(int(start), int(end) + 1))
+        elif part:
+            orders.append(int(part))
+    return orders
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return round(sorted_values[index], 3)
+
+
+def position_key(order, lat, lon):
+    return order, round(float(lat), 6), round(float(lon), 6)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.points = densify(ROUTE_POINTS, args.densify) * args.laps
+        self.sent_at = {}
+        self.pings_sent = 0
+        self.pings_per_order = {}
+        self.latencies = []
+        self.received = 0
+        self.unmatched = 0
+        self.connect_errors = 0
+        self.stop = asyncio.Event()
+
+    def _url(self, order, role):
+        url = f"{self.args.url.rstrip('/')}/ws/tracking/{order}/?role={role}"
+        if self.args.token:
+            url += f"&token={self.args.token}"
+        return url
+
+    async def driver(self, order, index, ready):
+        try:
+            async with websockets.connect(self._url(order, "publisher"), ping_interval=None) as ws:
+                drain = asyncio.create_task(self._drain(ws))
+                await ready.wait()
+                offset = index * DRIVER_OFFSET_DEG
+                for lat, lon in self.points:
+                    lat += offset
+                    self.sent_at[position_key(order, lat, lon)] = time.perf_counter()
+                    await ws.send(
+                        json.dumps(
+                            {
+                                "current_latitude": round(lat, 6),
+                                "current_longitude": round(lon, 6),
+                                "speed_kmh": self.args.speed,
+                                "heading": self.args.heading,
+                                "is_active": True,
+                            }
+                        )
+                    )
+                    self.pings_sent += 1
+                    self.pings_per_order[order] = self.pings_per_order.get(order, 0) + 1
+                    await asyncio.sleep(self.args.interval)
+                drain.cancel()
+        except (OSError, websockets.WebSocketException):
+            self.connect_errors += 1
+
+    async def _drain(self, ws):
+        async for _ in ws:
+            pass
+
+    async def subscriber(self, order, connected):
+        try:
+            async with websockets.connect(self._url(order, "subscriber"), ping_interval=None) as ws:
+                connected()
+                while not self.stop.is_set():
+                    try:
+                        message = await asyncio.wait_for(ws.recv(), timeout=0.5)
+                    except asyncio.TimeoutError:
+                        continue
+                    self._record(order, message, time.perf_counter())
+        except (OSError, websockets.WebSocketException):
+            self.connect_errors += 1
+            connected()
+
+    def _record(self, order, message, received_at):
+        try:
+            payload = json.loads(message)
+            key = position_key(order, payload["current_latitude"], payload["current_longitude"])
+        except (ValueError, KeyError, TypeError):
+            self.unmatched += 1
+            return
+        sent_at = self.sent_at.get(key)
+        if sent_at is None:
+            self.unmatched += 1
+            return
+        self.received += 1
+        self.latencies.append((received_at - sent_at) * 1000.0)
+
+    def fetch_metrics(self):
+        if not (self.args.http_url and self.args.token):
+            return None
+        request = Request(
+            f"{self.args.http_url.rstrip('/')}/api/metrics/",
+            headers={"Authorization": f"Bearer {self.args.token}"},
+        )
+        try:
+            with urlopen(request, timeout=5) as response:
+                return json.loads(response.read().decode("utf-8")).get("counters", {})
+        except Exception:
+            return None
+
+    async def run(self):
+        orders = parse_orders(self.args.orders)
+        before = await asyncio.to_thread(self.fetch_metrics)
+
+        subscriber_count = len(orders) * self.args.subscribers
+        subscribed = asyncio.Event()
+        pending = [subscriber_count]
+
+        def connected():
+            pending[0] -= 1
+            if pending[0] <= 0:
+                subscribed.set()
+
+        if subscriber_count == 0:
+            subscribed.set()
+        subscribers = [
+            asyncio.create_task(self.subscriber(order, connected))
+            for order in orders
+            for _ in range(self.args.subscribers)
+        ]
+        drivers = [
+            asyncio.create_task(self.driver(order, index, subscribed))
+            for order in orders
+            for index in range(self.args.drivers)
+        ]
+
+        await subscribed.wait()
+        started = time.perf_counter()
+        await asyncio.gather(*drivers)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(self.args.settle)
+        self.stop.set()
+        await asyncio.gather(*subscribers)
+
+        after = await asyncio.to_thread(self.fetch_metrics)
+        return self.report(orders, elapsed, before, after)
+
+    def report(self, orders, elapsed, before, after):
+        latencies = sorted(self.latencies)
+        expected = sum(self.pings_per_order.values()) * self.args.subscribers
+        server = None
+        if before is not None and after is not None:
+            delta = {key: after.get(key, 0) - before.get(key, 0) for key in after}
+            pings = delta.get("tracking.pings", 0)
+            server = {
+                "counters": delta,
+                "db_queries_per_ping": round(delta.get("tracking.ping.db_queries", 0) / pings, 3) if pings else None,
+            }
+        return {
+            "config": {
+                "orders": len(orders),
+                "drivers_per_order": self.args.drivers,
+                "subscribers_per_order": self.args.subscribers,
+                "interval_sec": self.args.interval,
+                "points_per_driver": len(self.points),
+            },
+            "duration_sec": round(elapsed, 3),
+            "pings_sent": self.pings_sent,
+            "pings_per_sec": round(self.pings_sent / elapsed, 2) if elapsed else None,
+            "broadcasts_expected": expected,
+            "broadcasts_received": self.received,
+            "broadcasts_missed": max(0, expected - self.received),
+            "broadcasts_per_sec": round(self.received / elapsed, 2) if elapsed else None,
+            "unmatched_messages": self.unmatched,
+            "connect_errors": self.connect_errors,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": round(latencies[-1], 3) if latencies else None,
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            },
+            "server": server,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracking websocket load generator.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000", help="Websocket base URL.")
+    parser.add_argument("--http-url", default="http://127.0.0.1:8000", help="HTTP base URL for /api/metrics/.")
+    parser.add_argument("--token", help="Admin JWT access token; drivers publish with it and it enables server metrics.")
+    parser.add_argument("--orders", default="104", help="Order ids, e.g. 104 or 100-149 or 1,2,3.")
+    parser.add_argument("--drivers", type=int, default=1, help="Drivers per order.")
+    parser.add_argument("--subscribers", type=int, default=1, help="Subscribers per order.")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between pings per driver.")
+    parser.add_argument("--densify", type=int, default=4, help="Interpolated points between route points.")
+    parser.add_argument("--laps", type=int, default=1, help="Times each driver replays the route.")
+    parser.add_argument("--speed", type=float, default=25)
+    parser.add_argument("--heading", type=float, default=254)
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to wait for late broadcasts.")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 06:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0002_remove_tracking_id_alter_tracking_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackingPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('heading', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('speed_kmh', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('recorded_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('tracking', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='points', to='tracking.tracking')),
+            ],
+            options={
+                'ordering': ('recorded_at',),
+                'constraints': [models.UniqueConstraint(fields=('tracking', 'recorded_at'), name='tracking_point_unique_time')],
+            },
+        ),
+    ]
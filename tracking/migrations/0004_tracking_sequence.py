@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 06:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0003_trackingpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tracking',
+            name='sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -22,6 +22,8 @@ class Tracking(models.Model):
     route_geometry = models.JSONField(default=dict, blank=True)
     last_ping_at = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=False)
+    # Bumped on every position update; broadcasts carry it so clients can resume.
+    sequence = models.PositiveBigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -30,3 +32,25 @@ class Tracking(models.Model):
 
     def __str__(self) -> str:  # pragma: no cover - human readable string
         return f"Tracking(order={self.order_id})"
+
+
+class TrackingPoint(models.Model):
+    """Position history, written in bulk from offline-buffered batches."""
+
+    tracking = models.ForeignKey(Tracking, on_delete=models.CASCADE, related_name="points")
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    heading = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    speed_kmh = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    recorded_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("recorded_at",)
+        constraints = [
+            # Replaying the same buffer after a flaky reconnect is a no-op.
+            models.UniqueConstraint(fields=("tracking", "recorded_at"), name="tracking_point_unique_time"),
+        ]
+
+    def __str__(self) -> str:  # pragma: no cover - human readable string
+        return f"TrackingPoint(order={self.tracking_id}, at={self.recorded_at})"
@@ -0,0 +1,40 @@
+"""
+Recommended ping interval for driver clients.
+
+After every ping the publisher gets ``{"type": "ping_interval", "seconds": n}``
+whenever the recommendation changes. Trips close to the dropoff ping fastest
+so arrival is detected promptly; moving trips ping about every
+``PING_SPACING_M`` metres; parked, unwatched or inactive trips ping rarely.
+"""
+
+PING_INTERVAL_MIN_SEC = 2
+PING_INTERVAL_MOVING_MAX_SEC = 15
+PING_INTERVAL_PARKED_SEC = 20
+PING_INTERVAL_UNWATCHED_SEC = 30
+PING_INTERVAL_INACTIVE_SEC = 60
+PING_SPACING_M = 150
+PARKED_SPEED_KMH = 3
+ARRIVING_DISTANCE_KM = 1.0
+APPROACHING_DISTANCE_KM = 5.0
+APPROACHING_MAX_SEC = 5
+
+
+def recommend_ping_interval(speed_kmh=None, distance_km=None, watchers=None, is_active=True) -> int:
+    """
+    ``watchers`` is the number of subscribers on the order, or ``None`` when
+    unknown (treated as watched).
+    """
+    if not is_active:
+        return PING_INTERVAL_INACTIVE_SEC
+    if distance_km is not None and distance_km <= ARRIVING_DISTANCE_KM:
+        return PING_INTERVAL_MIN_SEC
+    if watchers == 0:
+        return PING_INTERVAL_UNWATCHED_SEC
+    if speed_kmh is None or speed_kmh < PARKED_SPEED_KMH:
+        return PING_INTERVAL_PARKED_SEC
+
+    interval = PING_SPACING_M / (speed_kmh / 3.6)
+    upper = PING_INTERVAL_MOVING_MAX_SEC
+    if distance_km is not None and distance_km <= APPROACHING_DISTANCE_KM:
+        upper = APPROACHING_MAX_SEC
+    return int(round(max(PING_INTERVAL_MIN_SEC, min(upper, interval))))
@@ -1,7 +1,8 @@
 from django.urls import re_path
 
-from .consumers import TrackingConsumer
+from .consumers import FleetConsumer, TrackingConsumer
 
 websocket_urlpatterns = [
+    re_path(r"ws/tracking/fleet/$", FleetConsumer.as_asgi()),
     re_path(r"ws/tracking/(?P<order_id>\d+)/$", TrackingConsumer.as_asgi()),
 ]
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 
+from .ingest import MAX_BATCH_POINTS
 from .models import Tracking
 
 
@@ -16,7 +17,12 @@ class TrackingSerializer(serializers.ModelSerializer):
             "route_geometry",
             "last_ping_at",
             "is_active",
+            "sequence",
             "created_at",
             "updated_at",
         )
-        read_only_fields = ("created_at", "updated_at")
+        read_only_fields = ("sequence", "created_at", "updated_at")
+
+
+class TrackingBatchSerializer(serializers.Serializer):
+    points = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=MAX_BATCH_POINTS)
@@ -1,3 +1,442 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from moveline import metrics
+from orders.models import Order
+from .codecs import JSON_DELTA_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, MsgpackCodec, negotiate_codec
+from .consumers import replay_buffer
+from .geofence import ARRIVED, DEPARTED, GeofenceEngine
+from .ingest import ingest_batch, validate_batch
+from .models import Tracking, TrackingPoint
+from .pacing import PING_INTERVAL_MIN_SEC, PING_INTERVAL_UNWATCHED_SEC, recommend_ping_interval
+from .routing import websocket_urlpatterns
+from .views import TrackingViewSet
+
+
+class DeltaCodecTest(TestCase):
+    def test_keyframe_then_changed_fields_only(self):
+        codec = negotiate_codec({"subprotocols": [JSON_DELTA_SUBPROTOCOL]})
+        first = {"order": 1, "driver": 2, "current_latitude": "33.552516", "current_longitude": "36.388156", "is_active": True}
+        second = dict(first, current_latitude="33.552016")
+
+        keyframe = json.loads(codec.encode(first)["text_data"])
+        delta = json.loads(codec.encode(second)["text_data"])
+
+        self.assertEqual(keyframe["k"], 1)
+        self.assertEqual(keyframe["la"], 33552516)
+        self.assertEqual(delta, {"la": -500})
+        self.assertIsNot(codec, negotiate_codec({"subprotocols": [JSON_DELTA_SUBPROTOCOL]}))
+
+
+class PingIntervalTest(TestCase):
+    def test_recommendation(self):
+        self.assertEqual(recommend_ping_interval(speed_kmh=40, distance_km=0.3, watchers=0), PING_INTERVAL_MIN_SEC)
+        self.assertEqual(recommend_ping_interval(speed_kmh=40, distance_km=20, watchers=0), PING_INTERVAL_UNWATCHED_SEC)
+        self.assertEqual(recommend_ping_interval(speed_kmh=0, distance_km=20, watchers=2), 20)
+        self.assertEqual(recommend_ping_interval(speed_kmh=54, distance_km=20, watchers=2), 10)
+        self.assertEqual(recommend_ping_interval(speed_kmh=20, distance_km=3, watchers=2), 5)
+        self.assertEqual(recommend_ping_interval(speed_kmh=54, watchers=2, is_active=False), 60)
+
+
+class GeofenceEngineTest(TestCase):
+    def test_arrival_needs_confirmation_and_departure_uses_exit_radius(self):
+        order = Order(pickup_latitude=Decimal("33.500000"), pickup_longitude=Decimal("36.300000"))
+        engine = GeofenceEngine.for_order(order)
+        metres = 1 / 111_320
+
+        self.assertEqual(engine.update(33.5 + 50 * metres, 36.3), [])
+        self.assertEqual(engine.update(33.5 + 40 * metres, 36.3), [("pickup", ARRIVED)])
+        # Between the enter and exit radii the vehicle is still inside.
+        self.assertEqual(engine.update(33.5 + 120 * metres, 36.3), [])
+        self.assertEqual(engine.update(33.5 + 200 * metres, 36.3), [("pickup", DEPARTED)])
+        self.assertEqual(engine.update(33.5 + 200 * metres, 36.3), [])
+
+    def test_seeded_position_can_depart_without_arriving(self):
+        order = Order(pickup_latitude=Decimal("33.500000"), pickup_longitude=Decimal("36.300000"))
+        engine = GeofenceEngine.for_order(order)
+        engine.seed(Decimal("33.500100"), Decimal("36.300000"))
+        self.assertEqual(engine.update(33.5 + 200 / 111_320, 36.3), [("pickup", DEPARTED)])
+
+
+class TrackingConsumerTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.customer = User.objects.create_user(username="customer", password="pass")
+        self.driver = User.objects.create_user(username="driver", password="pass", role=User.Role.DRIVER)
+        self.order = Order.objects.create(
+            customer=self.customer,
+            driver=self.driver,
+            service_type=Order.ServiceType.MOVING,
+            pickup_address="Damascus",
+        )
+        Tracking.objects.create(
+            order=self.order,
+            driver=self.driver,
+            current_latitude=Decimal("33.552516"),
+            current_longitude=Decimal("36.388156"),
+            is_active=True,
+        )
+        replay_buffer.discard(str(self.order.id))
+
+    def _communicator(self, subprotocols=None, user=None, query=""):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f"/ws/tracking/{self.order.id}/{query}",
+            subprotocols=subprotocols,
+        )
+        communicator.scope["user"] = user or AnonymousUser()
+        return communicator
+
+    async def test_json_snapshot_on_connect(self):
+        communicator = self._communicator()
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["current_latitude"], "33.552516")
+        await communicator.disconnect()
+
+    async def test_ping_updates_record_with_one_query(self):
+        subscriber = self._communicator()
+        await subscriber.connect()
+        await subscriber.receive_json_from()
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        await publisher.receive_json_from()
+        self.assertEqual(await publisher.receive_json_from(), {"type": "ping_interval", "seconds": 20})
+        metrics.reset()
+
+        await publisher.send_json_to({"current_latitude": 33.5521, "speed_kmh": 20})
+        update = await subscriber.receive_json_from()
+        self.assertEqual(update["current_latitude"], "33.5521")
+        self.assertEqual(update["current_longitude"], "36.388156")
+        tracking = await Tracking.objects.aget(order_id=self.order.id)
+        self.assertEqual(tracking.current_latitude, Decimal("33.552100"))
+        self.assertEqual(metrics.snapshot()["counters"]["tracking.ping.db_queries"], 1)
+        self.assertEqual(metrics.snapshot()["histograms"], {})
+        # The driver's own ping is not echoed back; only the new interval is.
+        self.assertEqual(await publisher.receive_json_from(), {"type": "ping_interval", "seconds": 15})
+        self.assertTrue(await publisher.receive_nothing())
+        await publisher.disconnect()
+        await subscriber.disconnect()
+
+    async def test_first_ping_counts_the_record_load(self):
+        await Tracking.objects.filter(order=self.order).adelete()
+        publisher = self._communicator(user=self.driver)
+        self.assertTrue((await publisher.connect())[0])
+        await Tracking.objects.acreate(order=self.order, driver=self.driver, is_active=True)
+        metrics.reset()
+
+        await publisher.send_json_to({"current_latitude": 33.5521, "current_longitude": 36.3881})
+        self.assertEqual((await publisher.receive_json_from())["type"], "ping_interval")
+        await publisher.send_json_to({"current_latitude": 33.5522})
+        await publisher.receive_nothing()
+
+        # One SELECT for the record on the first ping, then one UPDATE each.
+        self.assertEqual(metrics.snapshot()["counters"]["tracking.ping.db_queries"], 3)
+        await publisher.disconnect()
+
+    async def test_ping_phases_are_timed_when_enabled(self):
+        metrics.reset()
+        metrics.set_enabled(True)
+        self.addCleanup(metrics.set_enabled, False)
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        await publisher.receive_json_from()
+        await publisher.send_json_to({"current_latitude": 33.5521})
+        await publisher.receive_json_from()
+        await publisher.receive_nothing()
+
+        histograms = metrics.snapshot()["histograms"]
+        for phase in ("", ".parse", ".db", ".routing", ".group_send"):
+            self.assertEqual(histograms[f"tracking.receive{phase}"]["count"], 1)
+        await publisher.disconnect()
+
+    async def test_subscriber_messages_are_ignored(self):
+        subscriber = self._communicator(user=self.customer)
+        await subscriber.connect()
+        await subscriber.receive_json_from()
+        await subscriber.send_json_to({"current_latitude": 1.0})
+        self.assertTrue(await subscriber.receive_nothing())
+        tracking = await Tracking.objects.aget(order_id=self.order.id)
+        self.assertEqual(tracking.current_latitude, Decimal("33.552516"))
+        await subscriber.disconnect()
+
+    async def test_publisher_role_requires_driver_or_staff(self):
+        communicator = self._communicator(user=self.customer, query="?role=publisher")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_msgpack_subprotocol_round_trip(self):
+        subscriber = self._communicator([MSGPACK_SUBPROTOCOL])
+        connected, subprotocol = await subscriber.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        snapshot = msgpack.unpackb(await subscriber.receive_from(), raw=False)
+        self.assertEqual(snapshot["la"], 33.552516)
+
+        publisher = self._communicator([MSGPACK_SUBPROTOCOL], user=self.driver)
+        await publisher.connect()
+        await publisher.receive_from()
+        await publisher.send_to(bytes_data=msgpack.packb({"la": 33.5521, "lo": 36.3881, "s": 20.5}))
+        update = MsgpackCodec().decode(bytes_data=await subscriber.receive_from())
+        self.assertEqual(update["current_latitude"], 33.5521)
+        self.assertEqual(update["speed_kmh"], 20.5)
+        await publisher.disconnect()
+        await subscriber.disconnect()
+
+    async def test_reconnect_replays_missed_updates_only(self):
+        watcher = self._communicator()
+        await watcher.connect()
+        snapshot = await watcher.receive_json_from()
+        self.assertEqual(snapshot["sequence"], 0)
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        for index in range(3):
+            await publisher.send_json_to({"current_latitude": 33.5521 + index / 10000})
+            self.assertEqual((await watcher.receive_json_from())["sequence"], index + 1)
+
+        metrics.reset()
+        resumed = self._communicator(query="?role=subscriber&last_seq=1")
+        await resumed.connect()
+        self.assertEqual([(await resumed.receive_json_from())["sequence"] for _ in range(2)], [2, 3])
+        self.assertTrue(await resumed.receive_nothing())
+        self.assertEqual(metrics.snapshot()["counters"]["tracking.resumed"], 1)
+
+        # A gap the buffer cannot bridge gets the full snapshot instead.
+        replay_buffer.discard(str(self.order.id))
+        stale = self._communicator(query="?role=subscriber&last_seq=1")
+        await stale.connect()
+        self.assertEqual((await stale.receive_json_from())["sequence"], 3)
+        for communicator in (publisher, watcher, resumed, stale):
+            await communicator.disconnect()
+
+    async def test_ping_broadcasts_the_stored_sequence(self):
+        watcher = self._communicator()
+        await watcher.connect()
+        await watcher.receive_json_from()
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        await publisher.send_json_to({"current_latitude": 33.5521})
+        self.assertEqual((await watcher.receive_json_from())["sequence"], 1)
+
+        # Another writer moves the record on behind this connection's back.
+        now_ms = int(timezone.now().timestamp() * 1000)
+        await sync_to_async(ingest_batch)(
+            str(self.order.id), [{"current_latitude": 33.5522, "current_longitude": 36.3881, "recorded_at": now_ms}]
+        )
+        await publisher.send_json_to({"current_latitude": 33.5523})
+        update = await watcher.receive_json_from()
+        self.assertEqual(
+            (update["sequence"], update["current_latitude"], update["current_longitude"]), (3, "33.5523", "36.388100")
+        )
+        tracking = await Tracking.objects.aget(order_id=self.order.id)
+        self.assertEqual(tracking.sequence, 3)
+        self.assertEqual(tracking.current_longitude, Decimal(update["current_longitude"]))
+        await publisher.disconnect()
+        await watcher.disconnect()
+
+    async def test_fence_check_uses_the_stored_order_status(self):
+        self.order.pickup_latitude = Decimal("33.552516")
+        self.order.pickup_longitude = Decimal("36.388156")
+        await self.order.asave()
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        await publisher.receive_json_from()
+        await publisher.receive_json_from()
+        # Assigned after the driver connected.
+        await Order.objects.filter(pk=self.order.pk).aupdate(status=Order.Status.ASSIGNED)
+
+        await publisher.send_json_to({"current_latitude": 33.5545})
+        event = await publisher.receive_json_from()
+        self.assertEqual(
+            event, {"type": "geofence", "fence": "pickup", "event": "departed", "order_status": "in_progress"}
+        )
+        self.assertEqual((await Order.objects.aget(pk=self.order.pk)).status, Order.Status.IN_PROGRESS)
+        await publisher.disconnect()
+
+    @mock.patch("tracking.consumers.urlopen", side_effect=OSError("no network in tests"))
+    async def test_dropoff_arrival_marks_order_delivered(self, urlopen):
+        self.order.status = Order.Status.IN_PROGRESS
+        self.order.dropoff_latitude = Decimal("33.553579")
+        self.order.dropoff_longitude = Decimal("36.385658")
+        await self.order.asave()
+        watcher = self._communicator()
+        await watcher.connect()
+        await watcher.receive_json_from()
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+
+        for lat in (33.553300, 33.553500, 33.553560):
+            await publisher.send_json_to({"current_latitude": lat, "current_longitude": 36.385700})
+        messages = [await watcher.receive_json_from() for _ in range(4)]
+        events = [message for message in messages if message.get("type") == "geofence"]
+        self.assertEqual(events, [{"type": "geofence", "fence": "dropoff", "event": "arrived", "order_status": "delivered"}])
+        order = await Order.objects.aget(pk=self.order.pk)
+        self.assertEqual(order.status, Order.Status.DELIVERED)
+        await publisher.disconnect()
+        await watcher.disconnect()
+
+    async def test_batch_applies_newest_point_and_keeps_history(self):
+        subscriber = self._communicator()
+        await subscriber.connect()
+        await subscriber.receive_json_from()
+        publisher = self._communicator(user=self.driver)
+        await publisher.connect()
+        await publisher.receive_json_from()
+        await publisher.receive_json_from()
+
+        now_ms = int(timezone.now().timestamp() * 1000)
+        points = [
+            {"current_latitude": 33.5523, "current_longitude": 36.3881, "recorded_at": now_ms - 2000},
+            {"current_latitude": 33.5524, "current_longitude": 36.3882, "recorded_at": now_ms - 1000},
+            {"current_latitude": 33.5522, "current_longitude": 36.3880, "recorded_at": now_ms - 3000},
+            {"current_latitude": 133.0, "current_longitude": 36.3880, "recorded_at": now_ms},
+        ]
+        await publisher.send_json_to({"type": "batch", "points": points})
+        self.assertEqual(await publisher.receive_json_from(), {"type": "batch_ack", "accepted": 3, "rejected": 1})
+        update = await subscriber.receive_json_from()
+        self.assertEqual(update["current_latitude"], "33.552400")
+        self.assertEqual(await TrackingPoint.objects.filter(tracking_id=self.order.id).acount(), 2)
+        await publisher.disconnect()
+        await subscriber.disconnect()
+
+
+class TrackingBatchViewTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.customer = User.objects.create_user(username="customer", password="pass")
+        self.driver = User.objects.create_user(username="driver", password="pass", role=User.Role.DRIVER)
+        self.order = Order.objects.create(
+            customer=self.customer,
+            driver=self.driver,
+            service_type=Order.ServiceType.MOVING,
+            pickup_address="Damascus",
+        )
+        Tracking.objects.create(order=self.order, driver=self.driver, is_active=True)
+        replay_buffer.discard(str(self.order.id))
+
+    def _post(self, user, points):
+        request = APIRequestFactory().post(f"/api/tracking/{self.order.id}/batch/", {"points": points}, format="json")
+        force_authenticate(request, user)
+        return TrackingViewSet.as_view({"post": "batch"})(request, pk=self.order.id)
+
+    def _points(self):
+        now = timezone.now()
+        return [
+            {"la": 33.55 + index / 10000, "lo": 36.38, "t": (now - timedelta(seconds=10 - index)).isoformat()}
+            for index in range(5)
+        ]
+
+    def test_driver_uploads_batch_once(self):
+        points = self._points()
+        response = self._post(self.driver, points)
+        self.assertEqual(response.data, {"accepted": 5, "rejected": 0, "applied": True})
+        tracking = Tracking.objects.get(order=self.order)
+        self.assertEqual(tracking.current_latitude, Decimal("33.550400"))
+        self.assertEqual(TrackingPoint.objects.count(), 4)
+        (buffered,) = replay_buffer.since(str(self.order.id), 0)
+        self.assertEqual((buffered["sequence"], buffered["current_latitude"]), (1, "33.550400"))
+
+        # Replaying the same buffer does not move the record backwards or
+        # duplicate history.
+        response = self._post(self.driver, points[:4])
+        self.assertFalse(response.data["applied"])
+        self.assertEqual(TrackingPoint.objects.count(), 4)
+
+    def test_batch_runs_the_fence_check(self):
+        self.order.status = Order.Status.IN_PROGRESS
+        self.order.dropoff_latitude = Decimal("33.553579")
+        self.order.dropoff_longitude = Decimal("36.385658")
+        self.order.save()
+        now = timezone.now()
+        points = [
+            {"la": lat, "lo": 36.3857, "t": (now - timedelta(seconds=3 - index)).isoformat()}
+            for index, lat in enumerate((33.5533, 33.5535, 33.55356))
+        ]
+
+        self.assertTrue(self._post(self.driver, points).data["applied"])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.Status.DELIVERED)
+
+    def test_customer_cannot_upload(self):
+        response = self._post(self.customer, self._points())
+        self.assertEqual(response.status_code, 403)
+
+    def test_validation_sorts_and_drops_bad_points(self):
+        now = timezone.now()
+        now_ms = now.timestamp() * 1000
+        columns, rejected = validate_batch(
+            [
+                {"la": 1, "lo": 1, "t": now_ms},
+                {"la": 2, "lo": 2, "t": now_ms - 1000},
+                {"la": 3, "lo": 3, "t": now_ms - 1000},
+                {"la": "x", "lo": 1, "t": now_ms},
+                {"la": 1, "lo": 1, "s": 900, "t": now_ms},
+                {"la": 1, "lo": 1, "t": (now - timedelta(days=30)).isoformat()},
+                "nonsense",
+            ],
+            now=now,
+        )
+        self.assertEqual(columns["latitude"].tolist(), [3.0, 1.0])
+        self.assertEqual(rejected, 5)
+
+
+class FleetConsumerTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        customer = User.objects.create_user(username="customer", password="pass")
+        self.staff = User.objects.create_user(username="ops", password="pass", is_staff=True)
+        self.order = Order.objects.create(
+            customer=customer,
+            service_type=Order.ServiceType.MOVING,
+            pickup_address="Damascus",
+        )
+        Tracking.objects.create(
+            order=self.order,
+            current_latitude=Decimal("33.552516"),
+            current_longitude=Decimal("36.388156"),
+            is_active=True,
+        )
+
+    def _communicator(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope["user"] = user
+        return communicator
+
+    async def test_rejects_non_staff(self):
+        communicator = self._communicator("/ws/tracking/fleet/", AnonymousUser())
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_viewport_snapshot_and_coalesced_updates(self):
+        fleet = self._communicator("/ws/tracking/fleet/", self.staff)
+        connected, _ = await fleet.connect()
+        self.assertTrue(connected)
+        await fleet.send_json_to({"action": "subscribe", "bbox": [36.38, 33.55, 36.39, 33.56]})
+        snapshot = await fleet.receive_json_from()
+        self.assertEqual([vehicle["order"] for vehicle in snapshot["vehicles"]], [self.order.id])
+
+        driver = self._communicator(f"/ws/tracking/{self.order.id}/?role=publisher", self.staff)
+        await driver.connect()
+        await driver.receive_from()
+        await driver.send_json_to({"current_latitude": 33.5521, "current_longitude": 36.3881})
+        await driver.send_json_to({"current_latitude": 33.5522, "current_longitude": 36.3882})
+        await driver.send_json_to({"current_latitude": 34.0, "current_longitude": 36.3882})
 
-# Create your tests here.
+        update = await fleet.receive_json_from(timeout=3)
+        self.assertEqual(update["vehicles"], [{"order": self.order.id, "removed": True}])
+        await driver.disconnect()
+        await fleet.disconnect()
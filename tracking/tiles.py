@@ -0,0 +1,73 @@
+"""
+Web Mercator tile index for the fleet map stream.
+
+Every tracking ping is published to the channel-layer group of the tile the
+vehicle is in, so a dashboard only joins the groups for the tiles on screen
+and the layer does the spatial filtering before fan-out.
+"""
+
+import math
+import sys
+
+FLEET_TILE_ZOOM = 12
+MAX_SUBSCRIBED_TILES = 256
+FLEET_ALL_GROUP = "fleet_all"
+MAX_LATITUDE = 85.05112878
+
+
+def tile_for(lat, lon, zoom=FLEET_TILE_ZOOM):
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, float(lat)))
+    lon = max(-180.0, min(180.0, float(lon)))
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(x, n - 1), min(y, n - 1)
+
+
+def tile_bbox(x, y, zoom=FLEET_TILE_ZOOM):
+    """Return ``(min_lon, min_lat, max_lon, max_lat)`` for a tile."""
+    n = 1 << zoom
+
+    def lat_at(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat_at(y + 1), (x + 1) / n * 360.0 - 180.0, lat_at(y)
+
+
+def tiles_for_bbox(min_lon, min_lat, max_lon, max_lat, zoom=FLEET_TILE_ZOOM, limit=MAX_SUBSCRIBED_TILES):
+    """
+    Index tiles covering a viewport, or ``None`` when more than ``limit``
+    tiles would be needed (the caller then falls back to the global group).
+    """
+    min_x, min_y = tile_for(max_lat, min_lon, zoom)
+    max_x, max_y = tile_for(min_lat, max_lon, zoom)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > limit:
+        return None
+    return {(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)}
+
+
+def index_tiles(tiles, zoom=FLEET_TILE_ZOOM, limit=MAX_SUBSCRIBED_TILES):
+    """
+    Map ``(z, x, y)`` tiles at any zoom onto index tiles, or ``None`` when
+    more than ``limit`` index tiles would be needed.
+    """
+    result = set()
+    for z, x, y in tiles:
+        if z >= zoom:
+            shift = z - zoom
+            result.add((x >> shift, y >> shift))
+        else:
+            span = 1 << (zoom - z)
+            if len(result) + span * span > limit:
+                return None
+            result.update(
+                (x * span + dx, y * span + dy) for dx in range(span) for dy in range(span)
+            )
+        if len(result) > limit:
+            return None
+    return result
+
+
+def tile_group(x, y, zoom=FLEET_TILE_ZOOM):
+    # Interned so dashboards watching the same tiles share the names.
+    return sys.intern(f"fleet_{zoom}_{x}_{y}")
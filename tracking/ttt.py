@@ -1,9 +1,13 @@
 import asyncio
 import json
+import os
 import websockets
 
-WS_URL = "ws://127.0.0.1:8000/ws/tracking/104/"
+# The driver's (or a staff user's) JWT; only publishers may send pings.
+TOKEN = os.environ.get("MOVELINE_TOKEN", "")
+WS_URL = f"ws://127.0.0.1:8000/ws/tracking/104/?role=publisher&token={TOKEN}"
 INTERVAL_SEC = 0.5
+FOLLOW_SERVER_INTERVAL = os.environ.get("MOVELINE_FOLLOW_INTERVAL") == "1"
 SPEED_KMH = 25
 HEADING = 254
 
@@ -41,10 +45,25 @@ def densify(points, step_count_between=4):
 
 DENSE_POINTS = densify(ROUTE_POINTS, 4)
 
+async def follow_ping_interval(ws, state):
+    # The server recommends the next ping interval; it is only followed
+    # with MOVELINE_FOLLOW_INTERVAL=1 so the demo route keeps its pace.
+    async for message in ws:
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            continue
+        if payload.get("type") == "ping_interval":
+            state["interval"] = payload["seconds"]
+            print(f"Server recommends pinging every {payload['seconds']}s")
+
+
 async def main():
+    state = {"interval": INTERVAL_SEC}
     # ping_interval=None => تعطيل keepalive ping
     async with websockets.connect(WS_URL, ping_interval=None) as ws:
-        print(f"Connected to {WS_URL}")
+        reader = asyncio.create_task(follow_ping_interval(ws, state))
+        print(f"Connected to {WS_URL.split('?')[0]}")
         print(f"Original points: {len(ROUTE_POINTS)} | Dense points: {len(DENSE_POINTS)}")
 
         for i, (lat, lon) in enumerate(DENSE_POINTS, start=1):
@@ -58,8 +77,9 @@ async def main():
             await ws.send(json.dumps(payload))
             if i % 20 == 0 or i in (1, len(DENSE_POINTS)):
                 print(f"Sent {i}/{len(DENSE_POINTS)}")
-            await asyncio.sleep(INTERVAL_SEC)
+            await asyncio.sleep(state["interval"] if FOLLOW_SERVER_INTERVAL else INTERVAL_SEC)
 
+        reader.cancel()
         print("Done sending route points.")
 
 if __name__ == "__main__":
@@ -1,9 +1,74 @@
-from rest_framework import viewsets
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework import exceptions, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 
+from .consumers import TrackingConsumer, replay_buffer
+from .geofence import GeofenceEngine, advance_order
+from .ingest import ingest_batch
 from .models import Tracking
-from .serializers import TrackingSerializer
+from .serializers import TrackingBatchSerializer, TrackingSerializer
+from .tiles import FLEET_ALL_GROUP, tile_for, tile_group
+from moveline import metrics
 
 
 class TrackingViewSet(viewsets.ModelViewSet):
     queryset = Tracking.objects.select_related("order", "driver").all()
     serializer_class = TrackingSerializer
+
+    @action(detail=True, methods=["post"], url_path="batch")
+    def batch(self, request, pk=None):
+        tracking = self.get_object()
+        user = request.user
+        if user.pk not in (tracking.driver_id, tracking.order.driver_id) and not (
+            user.is_staff or user.role == user.Role.ADMIN
+        ):
+            raise exceptions.PermissionDenied("Only the order's driver can upload positions.")
+
+        serializer = TrackingBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # Fences start from the position before the batch, as a live
+        # connection's would.
+        geofence = GeofenceEngine.for_order(tracking.order)
+        geofence.seed(tracking.current_latitude, tracking.current_longitude)
+        result = ingest_batch(tracking.order_id, serializer.validated_data["points"], tracking.is_active)
+
+        if result["latest"] is not None:
+            tracking.refresh_from_db()
+            self._broadcast(TrackingConsumer._tracking_payload(tracking))
+            self._apply_geofence(tracking.order, geofence, result["track"])
+        return Response(
+            {"accepted": result["accepted"], "rejected": result["rejected"], "applied": result["latest"] is not None},
+            status=status.HTTP_200_OK,
+        )
+
+    @staticmethod
+    def _apply_geofence(order, geofence, track):
+        channel_layer = get_channel_layer()
+        order_status = order.status
+        for lat, lon in track:
+            for fence, event in geofence.update(lat, lon):
+                metrics.increment(f"tracking.geofence.{fence}.{event}")
+                order_status = advance_order(order.pk, order_status, fence, event)
+                message = {"type": "geofence", "fence": fence, "event": event, "order_status": order_status}
+                if channel_layer is not None:
+                    async_to_sync(channel_layer.group_send)(
+                        f"tracking_{order.pk}", {"type": "tracking.event", "event": message}
+                    )
+
+    @staticmethod
+    def _broadcast(payload):
+        # Consumers buffer what they receive, but this process may have none
+        # for the order; without the entry its replays would have a gap.
+        replay_buffer.append(str(payload["order"]), payload["sequence"], payload)
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        groups = [f"tracking_{payload['order']}", FLEET_ALL_GROUP]
+        if payload["current_latitude"] is not None and payload["current_longitude"] is not None:
+            groups.append(tile_group(*tile_for(payload["current_latitude"], payload["current_longitude"])))
+        send = async_to_sync(channel_layer.group_send)
+        send(groups[0], {"type": "tracking.update", "payload": payload})
+        for group in groups[1:]:
+            send(group, {"type": "fleet.update", "payload": payload})
@@ -0,0 +1,42 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Populates ``scope["user"]`` for websocket connections from a JWT access
+    token passed as ``?token=<jwt>`` or an ``Authorization: Bearer`` header.
+    Connections without a valid token get ``AnonymousUser``.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope["user"] = await self._get_user(self._raw_token(scope))
+        return await self.inner(scope, receive, send)
+
+    @staticmethod
+    def _raw_token(scope):
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                parts = value.split()
+                if len(parts) == 2 and parts[0].lower() == b"bearer":
+                    return parts[1]
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        token = query.get("token")
+        return token[0].encode("latin-1") if token else None
+
+    @database_sync_to_async
+    def _get_user(self, raw_token):
+        if not raw_token:
+            return AnonymousUser()
+        authentication = JWTAuthentication()
+        try:
+            return authentication.get_user(authentication.get_validated_token(raw_token))
+        except (InvalidToken, TokenError, AuthenticationFailed):
+            return AnonymousUser()